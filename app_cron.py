@@ -1,14 +1,28 @@
 # 版本號碼：v1.7.2
 print(">>> [系統啟動] v1.7.2 精選績優版：漲幅限制 20%、市值門檻 100M、維持高清五段紅綠視覺...")
 
-import os, time, datetime, io, base64, requests, glob, json
+import os, time, datetime, io, requests, glob, json, atexit, asyncio, contextlib, functools, hashlib, itertools, math, multiprocessing, random, re, sys, types, queue, threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, BrokenExecutor, CancelledError, TimeoutError as FutureTimeout
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
 import yfinance as yf
 from bs4 import BeautifulSoup
 import plotly.graph_objects as go
+import plotly.io as pio
 from plotly.subplots import make_subplots
 import pytz
 
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+try:
+    import resource
+except ImportError:  # Windows 沒有 resource 模組，記憶體高峰改記 None
+    resource = None
+
 try:
     from google import genai
 except ImportError:
@@ -20,20 +34,114 @@ except ImportError:
 VERSION = "v1.7.2"
 GEMINI_KEY = os.getenv("GEMINI_API_KEY")
 TARGET_MODEL = "models/gemini-2.5-flash"
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "10"))  # 依實際 API 配額調整 (免費層 gemini-2.5-flash 為 10 RPM)
+GEMINI_MAX_BATCH = int(os.getenv("GEMINI_MAX_BATCH", "8"))
+GEMINI_RETRIES = 4
+AI_CACHE_DIR = os.path.join("data", "ai_cache")
 TEST_MODE = False 
+FINVIZ_URL = "https://finviz.com/screener.ashx?v=111&f=ind_stocksonly,sh_curvol_o500,sh_price_o1,sh_relvol_o5,ta_change_u"
+FINVIZ_WORKERS = 4
+FINVIZ_MAX_PAGES = 50
+FINVIZ_CACHE_DIR = os.path.join("data", "finviz")
+FINVIZ_CACHE_TTL = int(os.getenv("FINVIZ_CACHE_TTL", "900"))  # 秒；重複執行時在此期間內直接使用快取頁面
+MAX_CHANGE_PCT = 20
+MIN_MKT_CAP = 100000000
+OHLCV_DIR = os.path.join("data", "ohlcv")
+OHLCV_FIELDS = ["Open", "High", "Low", "Close", "Volume"]
+HISTORY_YEARS = 4
+OHLCV_OVERLAP_DAYS = 7     # 增量更新時往前多抓的日曆天數，用來比對已存的完整 K 棒
+OHLCV_ADJ_RTOL = 1e-4      # 重疊 K 棒收盤價相對誤差超過此值即視為資料源已重新還原權值 (分割 / 除息)
+JOURNAL_DIR = os.path.join("data", "runs")
+JOURNAL_FLUSH_SECS = 2.0
+INDICATOR_DIR = os.path.join("data", "indicators")
+INDICATOR_COLS = ["SMA20", "SMA50", "SMA200", "MACD", "Signal", "Hist", "RSI"]
+INDICATOR_WARMUP = 199  # 增量計算時往前帶入的 K 棒數 (SMA200 視窗，亦涵蓋 RSI 14)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "120"))
+RENDER_SCALE = 3
+PIPELINE_CHUNK = 25  # 資料階段每批下載 / 計算指標的標的數
+PIPELINE_QUEUE = 4   # 階段間佇列上限，控制同時在途的標的數與記憶體
+ASSET_DIR = "assets"
+CHART_MODE = os.getenv("CHART_MODE", "png")  # png：kaleido 伺服器端出圖；client：只輸出 JSON，由瀏覽器 plotly.js 繪圖
+PROFILE_DIR = os.path.join("data", "profiles")
+
+# ==========================================
+# 1.1 執行剖析 (逐階段 / 逐檔記錄牆鐘時間、CPU 時間與記憶體高峰)
+# ==========================================
+def _peak_rss_mb():
+    """本行程從啟動至今的常駐記憶體高峰 (MB，只增不減)；不支援的平台回傳 None"""
+    if resource is None: return None
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(r / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+class RunProfiler:
+    """執行緒安全的剖析器：stage() 包住一段程式並記一筆 (階段, 標的, 牆鐘秒數, 該執行緒 CPU 秒數, RSS 高峰拉高量, 結束時的行程 RSS 高峰)；
+    在其他行程量測的結果 (渲染池) 以 add() 補記。例外照常往外拋，但會留下 error 欄位。
+    ru_maxrss 是行程的歷史高峰，單一階段能歸屬的只有「期間把高峰拉高了多少」(growth)；並行的階段可能互相分攤到對方的增量"""
+    def __init__(self):
+        self.lock = threading.Lock(); self.reset()
+
+    def reset(self):
+        with self.lock: self.records, self.t0, self.started = [], time.perf_counter(), datetime.datetime.now(pytz.utc)
+
+    def add(self, stage, ticker=None, wall=0.0, cpu=0.0, growth=None, peak=None, error=None):
+        rec = {"stage": stage, "ticker": ticker, "wall": round(wall, 4), "cpu": round(cpu, 4), "growth": growth, "peak": peak}
+        if error is not None: rec["error"] = str(error)[:200]
+        with self.lock: self.records.append(rec)
+
+    @contextlib.contextmanager
+    def stage(self, stage, ticker=None):
+        w0, c0, r0, err = time.perf_counter(), time.thread_time(), _peak_rss_mb(), None
+        try: yield
+        except BaseException as e: err = repr(e); raise
+        finally:
+            r1 = _peak_rss_mb()
+            self.add(stage, ticker, time.perf_counter() - w0, time.thread_time() - c0, None if r1 is None else round(r1 - r0, 1), r1, err)
+
+    def timed(self, stage):
+        """裝飾器版本：整個函式呼叫記為一筆"""
+        def deco(fn):
+            @functools.wraps(fn)
+            def wrap(*args, **kwargs):
+                with self.stage(stage): return fn(*args, **kwargs)
+            return wrap
+        return deco
+
+    def summary(self, **meta):
+        """彙總成可序列化的剖析結果：stages 為各階段次數 / 總計 / 最大值 / 失敗數、RSS 高峰拉高量合計 (growth) 與
+        階段結束時所見的行程 RSS 高峰 (peak_so_far，to_image 為渲染 worker 行程)；tickers 為各標的逐階段的牆鐘 / CPU 秒數與 RSS 高峰拉高量"""
+        with self.lock: recs = list(self.records)
+        stages, tickers = {}, {}
+        for r in recs:
+            s = stages.setdefault(r["stage"], {"n": 0, "wall": 0.0, "cpu": 0.0, "max": 0.0, "growth": None, "peak_so_far": None, "errors": 0})
+            s["n"] += 1; s["wall"] += r["wall"]; s["cpu"] += r["cpu"]; s["max"] = max(s["max"], r["wall"]); s["errors"] += "error" in r
+            if r["growth"] is not None: s["growth"] = round((s["growth"] or 0) + r["growth"], 1)
+            if r["peak"] is not None: s["peak_so_far"] = max(s["peak_so_far"] or 0, r["peak"])
+            if r["ticker"]:
+                tk = tickers.setdefault(r["ticker"], {}).setdefault(r["stage"], {"wall": 0.0, "cpu": 0.0, "growth": None})
+                tk["wall"] = round(tk["wall"] + r["wall"], 4); tk["cpu"] = round(tk["cpu"] + r["cpu"], 4)
+                if r["growth"] is not None: tk["growth"] = round((tk["growth"] or 0) + r["growth"], 1)
+        for s in stages.values(): s["wall"], s["cpu"], s["max"] = round(s["wall"], 3), round(s["cpu"], 3), round(s["max"], 3)
+        return {"version": VERSION, "started": self.started.isoformat(timespec="seconds"), "elapsed": round(time.perf_counter() - self.t0, 3),
+                "peak_rss_mb": _peak_rss_mb(), **meta, "stages": stages, "tickers": tickers}
+
+    def save(self, path, **meta):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        prof = self.summary(**meta)
+        with open(path + ".tmp", "w", encoding="utf-8") as f: json.dump(prof, f, ensure_ascii=False, indent=1)
+        os.replace(path + ".tmp", path)
+        return prof
+
+PROFILER = RunProfiler()
 
 # ==========================================
 # 2. 數據抓取與精準過濾 (新增市值門檻 100M & 漲幅限制 20%)
 # ==========================================
-def parse_mkt_cap(val_str):
-    """將 Finviz 的市值字串 (如 1.5B, 100M) 轉換為數字以供比較"""
-    try:
-        val_str = val_str.upper()
-        if 'T' in val_str: return float(val_str.replace('T', '')) * 1000000000000
-        if 'B' in val_str: return float(val_str.replace('B', '')) * 1000000000
-        if 'M' in val_str: return float(val_str.replace('M', '')) * 1000000
-        return float(val_str)
-    except: return 0.0
+def parse_mkt_cap(values):
+    """將 Finviz 的市值字串欄 (如 1.5B, 100M) 向量化轉為數字，無法解析者為 0"""
+    s = values.astype(str).str.strip().str.upper()
+    mult = s.str[-1:].map({'T': 1e12, 'B': 1e9, 'M': 1e6}).fillna(1.0)
+    return (pd.to_numeric(s.str.rstrip('TBM'), errors='coerce') * mult).fillna(0.0)
 
 def is_market_open_today():
     if TEST_MODE: return True
@@ -44,51 +152,286 @@ def is_market_open_today():
         spy = yf.Ticker("SPY")
         hist = spy.history(period="1d")
         return not hist.empty
-    except: return True
+    except Exception as e: print(f"⚠️ 開盤檢查失敗，視為開盤: {e}"); return True
+
+def _finviz_session():
+    session = requests.Session(); session.headers.update({'User-Agent': 'Mozilla/5.0'})
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=FINVIZ_WORKERS, max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]))
+    session.mount("https://", adapter); session.mount("http://", adapter)
+    return session
+
+@PROFILER.timed("scrape_page")
+def fetch_screener_page(session, url, cache_dir=None, ttl=None):
+    """抓單頁並把原始 HTML 存到磁碟：TTL 內直接讀檔；過期時帶 ETag / Last-Modified 條件請求，304 則沿用快取。
+    兩個快取檔都以暫存檔 + os.replace 寫入；讀不出來 (中斷寫入、損毀) 時當作沒有快取"""
+    cache_dir = cache_dir or FINVIZ_CACHE_DIR; ttl = FINVIZ_CACHE_TTL if ttl is None else ttl
+    os.makedirs(cache_dir, exist_ok=True)
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    body_path, meta_path = os.path.join(cache_dir, key + ".html"), os.path.join(cache_dir, key + ".json")
+    meta, cached = {}, None
+    try:
+        with open(meta_path, encoding="utf-8") as f: meta = json.load(f)
+        with open(body_path, encoding="utf-8") as f: cached = f.read()
+    except (OSError, ValueError): meta, cached = {}, None
+    if cached is not None and time.time() - meta.get("fetched", 0) < ttl: return cached
+    headers = {}
+    if cached is not None and meta.get("etag"): headers["If-None-Match"] = meta["etag"]
+    if cached is not None and meta.get("last_modified"): headers["If-Modified-Since"] = meta["last_modified"]
+    resp = session.get(url, headers=headers, timeout=20)
+    if resp.status_code == 304 and cached is not None: text = cached
+    else:
+        resp.raise_for_status(); text = resp.text
+        with open(body_path + ".tmp", "w", encoding="utf-8") as f: f.write(text)
+        os.replace(body_path + ".tmp", body_path)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"url": url, "fetched": time.time(), "etag": resp.headers.get("ETag") or meta.get("etag"),
+                   "last_modified": resp.headers.get("Last-Modified") or meta.get("last_modified")}, f)
+    os.replace(meta_path + ".tmp", meta_path)
+    return text
+
+def parse_screener_html(text):
+    """回傳 (每列儲存格文字清單, 篩選結果總筆數 或 None)；有 lxml 時用 lxml，否則退回 BeautifulSoup"""
+    if lxml_html is not None:
+        doc = lxml_html.fromstring(text)
+        rows = [[td.text_content().strip() for td in tr.iterfind('td')] for tr in doc.iterfind('.//tr[@valign="top"]')]
+        plain = doc.text_content()
+    else:
+        soup = BeautifulSoup(text, 'html.parser')
+        rows = [[td.text.strip() for td in tr.find_all('td')] for tr in soup.find_all('tr', valign="top")]
+        plain = soup.get_text(" ")
+    m = re.search(r'/\s*([\d,]+)\s*Total', plain) or re.search(r'Total:\s*([\d,]+)', plain)
+    return rows, (int(m.group(1).replace(',', '')) if m else None)
+
+def filter_screener_rows(rows):
+    """以 DataFrame 向量運算套用篩選條件：漲幅 <= 20%、市值 >= 100M、排除空殼公司"""
+    cols = ["No", "Ticker", "Company", "Sector", "Industry", "Country", "MarketCap", "PE", "Price", "Change", "Volume"]
+    df = pd.DataFrame([r[:11] for r in rows if len(r) >= 11], columns=cols)
+    change = pd.to_numeric(df['Change'].str.strip('%'), errors='coerce')
+    price = pd.to_numeric(df['Price'], errors='coerce')
+    shell = df['Company'].str.lower().str.contains('shell') | df['Industry'].str.lower().str.contains('shell')
+    keep = change.notna() & price.notna() & (change <= MAX_CHANGE_PCT) & (parse_mkt_cap(df['MarketCap']) >= MIN_MKT_CAP) & ~shell
+    df = df.assign(Price=price, Change=change)[keep]
+    return df[["Ticker", "Company", "Industry", "MarketCap", "PE", "Price", "Change", "Volume"]].drop_duplicates('Ticker').reset_index(drop=True)
 
-def fetch_and_filter_stocks():
+@PROFILER.timed("scrape")
+def fetch_and_filter_stocks(base_url=FINVIZ_URL, session=None, cache_dir=None, ttl=None):
     print(f">>> [步驟 1] 抓取數據並執行精準篩選 (漲幅<20% & 市值>100M)...")
-    url = "https://finviz.com/screener.ashx?v=111&f=ind_stocksonly,sh_curvol_o500,sh_price_o1,sh_relvol_o5,ta_change_u"
-    headers = {'User-Agent': 'Mozilla/5.0'}
+    session = session or _finviz_session()
+
+    def get_page(url):
+        try: return parse_screener_html(fetch_screener_page(session, url, cache_dir, ttl))[0]
+        except Exception as e: print(f"⚠️ 分頁抓取失敗 {url}: {e}"); return []
+
     try:
-        resp = requests.get(url, headers=headers, timeout=20)
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        rows = soup.find_all('tr', valign="top")
-        data = []
-        for r in rows:
-            tds = r.find_all('td')
-            if len(tds) < 11: continue
-            try:
-                name = tds[2].text.strip()
-                industry = tds[4].text.strip()
-                mkt_cap_str = tds[6].text.strip()
-                change_val = float(tds[9].text.strip('%'))
-                
-                # --- 精準過濾邏輯 ---
-                # 1. 漲幅限制：原本 40% 改為 20%
-                if change_val > 20: continue 
-                # 2. 市值限制：必須超過 100M (一億美元)
-                if parse_mkt_cap(mkt_cap_str) < 100000000: continue
-                # 3. 排除空殼公司
-                if "shell" in name.lower() or "shell" in industry.lower(): continue
-
-                data.append({
-                    "Ticker": tds[1].text.strip(), "Company": name,
-                    "Industry": industry, "MarketCap": mkt_cap_str,
-                    "PE": tds[7].text.strip(), "Price": float(tds[8].text.strip()), 
-                    "Change": change_val, "Volume": tds[10].text.strip()
-                })
-            except: continue
-        df = pd.DataFrame(data)
+        rows, total = parse_screener_html(fetch_screener_page(session, base_url, cache_dir, ttl))
+        # Finviz 每頁固定筆數，以 r= 指定起始序號；其餘分頁共用連線池平行抓取
+        step = len(rows) or 20
+        starts = list(range(step + 1, (total or 0) + 1, step))[:FINVIZ_MAX_PAGES - 1]
+        with ThreadPoolExecutor(max_workers=FINVIZ_WORKERS) as ex:
+            for page in ex.map(get_page, [f"{base_url}&r={r}" for r in starts]): rows += page
+        df = filter_screener_rows(rows)
+        print(f"   ↳ Finviz 共 {total or len(rows)} 筆 ({len(starts) + 1} 頁)，篩選後 {len(df)} 支")
         if df.empty: return df
         df = df.sort_values(by=['Industry', 'Ticker'], ascending=[True, True])
         return df.head(2) if TEST_MODE else df
     except Exception as e:
         print(f"❌ 抓取失敗: {e}"); return pd.DataFrame()
 
+# ==========================================
+# 2.1 本地 OHLCV 資料庫 (增量更新、批次下載、mmap 零複製讀取)
+# ==========================================
+def _ohlcv_path(ticker, root=None):
+    return os.path.join(root or OHLCV_DIR, f"{ticker}.npy")
+
+def _today_ny():
+    return datetime.datetime.now(pytz.timezone('America/New_York')).date()
+
+def load_ohlcv(ticker, root=None):
+    """以 mmap 唯讀載入單一標的日線；檔案為 (6, N) float64，第 0 列為 epoch 日數，其餘為 OHLCV"""
+    path = _ohlcv_path(ticker, root)
+    if not os.path.exists(path): return pd.DataFrame(columns=OHLCV_FIELDS, dtype=float)
+    arr = np.load(path, mmap_mode='r')
+    idx = pd.DatetimeIndex(arr[0].astype('int64').astype('datetime64[D]'), name="Date")
+    # 每個欄位在檔案中連續存放，轉置後即為 DataFrame 的 block，不需複製
+    return pd.DataFrame(arr[1:].T, index=idx, columns=OHLCV_FIELDS, copy=False)
+
+def _last_stored_day(ticker, root=None):
+    path = _ohlcv_path(ticker, root)
+    if not os.path.exists(path): return None
+    arr = np.load(path, mmap_mode='r')
+    return int(arr[0, -1]) if arr.shape[1] else None
+
+def _save_ohlcv(ticker, df_new, root=None, today=None, replace=False):
+    """合併新資料 (同日以新資料覆蓋；replace 時整檔取代)、截掉超過 HISTORY_YEARS 的舊資料後原子寫回"""
+    path = _ohlcv_path(ticker, root); os.makedirs(os.path.dirname(path), exist_ok=True)
+    idx = df_new.index.tz_localize(None) if df_new.index.tz is not None else df_new.index
+    days = idx.values.astype('datetime64[D]').astype('int64')
+    new = np.vstack([days.astype('float64'), df_new[OHLCV_FIELDS].to_numpy(dtype='float64').T])
+    if os.path.exists(path) and not replace:
+        old = np.load(path)
+        new = np.hstack([old[:, old[0] < days.min()], new]) if len(days) else old
+    cutoff = (np.datetime64(today or _today_ny(), 'D') - np.timedelta64(HISTORY_YEARS * 365, 'D')).astype('int64')
+    new = np.ascontiguousarray(new[:, new[0] >= cutoff])
+    tmp = path[:-4] + ".tmp.npy"
+    np.save(tmp, new); os.replace(tmp, path)
+
+def _history_rewritten(ticker, df_new, root=None):
+    """比對重新下載的重疊區間與本地已存的收盤價：資料源在分割 / 除息後會改寫整段還原價，只補新 K 棒會留下假跳空。
+    已存的最後一根可能是盤中抓到的未完成 K 棒，有更早的重疊 K 棒時不拿它比對"""
+    arr = np.load(_ohlcv_path(ticker, root), mmap_mode='r')
+    idx = df_new.index.tz_localize(None) if df_new.index.tz is not None else df_new.index
+    days = idx.values.astype('datetime64[D]').astype('int64')
+    pos = np.flatnonzero(np.isin(arr[0], days))
+    if len(pos) > 1: pos = pos[:-1]
+    if not len(pos): return False
+    stored = np.asarray(arr[4, pos]); fresh = df_new['Close'].to_numpy(dtype='float64')[np.searchsorted(days, arr[0, pos].astype('int64'))]
+    return not np.allclose(fresh, stored, rtol=OHLCV_ADJ_RTOL, atol=0, equal_nan=True)
+
+def _split_download(raw, tickers):
+    """把 yf.download 的多標的結果拆成 {ticker: OHLCV DataFrame}"""
+    if raw is None or raw.empty: return {}
+    frames = {}
+    if isinstance(raw.columns, pd.MultiIndex):
+        for lv in range(raw.columns.nlevels):
+            names = set(raw.columns.get_level_values(lv))
+            for t in tickers:
+                if t in names and t not in frames: frames[t] = raw.xs(t, axis=1, level=lv)
+    elif len(tickers) == 1: frames[tickers[0]] = raw
+    out = {}
+    for t, d in frames.items():
+        if not set(OHLCV_FIELDS) <= set(d.columns): continue
+        d = d[OHLCV_FIELDS].dropna(how='all')
+        if not d.empty: out[t] = d
+    return out
+
+@PROFILER.timed("download")
+def update_ohlcv_store(tickers, downloader=None, root=None, today=None):
+    """只下載缺少的日期區間：新標的抓 HISTORY_YEARS 年，既有標的從最後一根往前 OHLCV_OVERLAP_DAYS 天開始補齊；
+    重疊區間的收盤價與本地不符 (分割 / 除息後重新還原) 的標的改抓整段 HISTORY_YEARS 年並整檔取代。
+    downloader 與 yf.download 介面相同，可注入假資料以離線測試。回傳 {ticker: 錯誤訊息} (僅含失敗者)。"""
+    downloader = downloader or yf.download
+    today = today or _today_ny()
+    today_day = int(np.datetime64(today, 'D').astype('int64'))
+    last = {t: _last_stored_day(t, root) for t in dict.fromkeys(tickers)}
+    fresh = [t for t, d in last.items() if d is None]
+    stale = [t for t, d in last.items() if d is not None and d < today_day]
+    print(f"   ↳ 本地行情庫：新增 {len(fresh)} 支、增量更新 {len(stale)} 支、已是最新 {len(last)-len(fresh)-len(stale)} 支")
+    jobs, errors = [], {}
+    if fresh: jobs.append((fresh, dict(period=f"{HISTORY_YEARS}y")))
+    if stale:
+        start = str(np.datetime64(min(last[t] for t in stale) - OHLCV_OVERLAP_DAYS, 'D'))
+        jobs.append((stale, dict(start=start)))
+    while jobs:
+        group, span = jobs.pop(0)
+        try:
+            raw = downloader(group, interval="1d", group_by="ticker", progress=False, threads=True, **span)
+        except Exception as e:
+            print(f"❌ 行情下載失敗 ({len(group)} 支): {e}"); errors.update((t, f"行情下載失敗: {e}") for t in group); continue
+        full, rewritten = "period" in span, []
+        for t, d in _split_download(raw, group).items():
+            if not full and _history_rewritten(t, d, root): rewritten.append(t); continue
+            _save_ohlcv(t, d, root, today, replace=full)
+        if rewritten:
+            print(f"   ↳ {len(rewritten)} 支歷史價格已被重新還原 (分割 / 除息)，改抓整段 {HISTORY_YEARS} 年：{', '.join(rewritten[:10])}{'…' if len(rewritten) > 10 else ''}")
+            jobs.append((rewritten, dict(period=f"{HISTORY_YEARS}y")))
+    for t in last:
+        if t not in errors and _last_stored_day(t, root) is None: errors[t] = "下載結果無資料"
+    return errors
+
+# ==========================================
+# 2.2 指標引擎 (全標的向量化面板、EMA 狀態跨日延續、只補新 K 棒)
+# ==========================================
+def _rolling_mean(x, w):
+    """沿時間軸的 rolling(w, min_periods=1).mean()，與 pandas 相同地略過 NaN"""
+    valid = ~np.isnan(x); zero = np.zeros((1, x.shape[1]))
+    cs = np.vstack([zero, np.cumsum(np.where(valid, x, 0.0), axis=0)])
+    cn = np.vstack([zero, np.cumsum(valid, axis=0)])
+    lo = np.maximum(np.arange(1, len(x) + 1) - w, 0)
+    n = cn[1:] - cn[lo]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, (cs[1:] - cs[lo]) / np.maximum(n, 1), np.nan)
+
+def _ema_step(e, x, alpha):
+    # ewm(adjust=False)：第一個有效值直接作為起點，NaN 輸入保留前值
+    return np.where(np.isnan(x), e, np.where(np.isnan(e), x, alpha * x + (1 - alpha) * e))
+
+def compute_indicator_panel(close, exists, n_new, seeds):
+    """close / exists 為 (K 棒, 標的) 面板，各標的靠右對齊、上方以 NaN 補齊。
+    只有每欄最後 n_new 列會計算 EMA 系列；seeds 為 (3, 標的) 的 EMA12/EMA26/Signal 起始狀態 (NaN 表示從頭算)。
+    回傳 (指標 (7, K 棒, 標的), 最後狀態 (3, 標的))，公式與原本 pandas rolling/ewm 版本一致。"""
+    L = close.shape[0]
+    out = np.full((len(INDICATOR_COLS),) + close.shape, np.nan)
+    out[0], out[1], out[2] = _rolling_mean(close, 20), _rolling_mean(close, 50), _rolling_mean(close, 200)
+    delta = np.diff(close, axis=0, prepend=np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        g = np.where(exists, np.where(delta > 0, delta, 0.0), np.nan)
+        l = np.where(exists, np.where(delta < 0, -delta, 0.0), np.nan)
+        out[6] = 100 - (100 / (1 + _rolling_mean(g, 14) / _rolling_mean(l, 14)))
+    e12, e26, sig = (seeds[k].copy() for k in range(3))
+    start = L - n_new
+    for t in range(L - int(n_new.max(initial=0)), L):
+        act = t >= start
+        e12 = np.where(act, _ema_step(e12, close[t], 2 / 13), e12)
+        e26 = np.where(act, _ema_step(e26, close[t], 2 / 27), e26)
+        macd = e12 - e26
+        sig = np.where(act, _ema_step(sig, macd, 2 / 10), sig)
+        out[3, t] = np.where(act, macd, np.nan); out[4, t] = np.where(act, sig, np.nan)
+    out[5] = out[3] - out[4]
+    return out, np.vstack([e12, e26, sig])
+
+def _load_indicator_state(root=None):
+    path = os.path.join(root or INDICATOR_DIR, "state.json")
+    if not os.path.exists(path): return {}
+    with open(path, encoding="utf-8") as f: return json.load(f)
+
+@PROFILER.timed("indicators")
+def update_indicator_store(tickers, root=None, ind_root=None):
+    """一次為所有標的更新指標並回傳 {ticker: OHLCV + 指標 DataFrame}。
+    前次的指標與 EMA 狀態存在 ind_root；行情庫前段未變時只計算新增的 K 棒，否則 (首次、分割/除權改寫歷史) 整段重算。"""
+    ind_root = ind_root or INDICATOR_DIR; os.makedirs(ind_root, exist_ok=True)
+    state = _load_indicator_state(ind_root)
+    plan = []
+    for t in dict.fromkeys(tickers):
+        df = load_ohlcv(t, root)
+        if df.empty: continue
+        df = df.ffill()
+        days = df.index.values.astype('datetime64[D]').astype('int64')
+        st, old, path = state.get(t), None, os.path.join(ind_root, f"{t}.npy")
+        if st and os.path.exists(path):
+            old = np.load(path); old = old[:, old[0] >= days[0]]
+            k = old.shape[1]
+            if not (0 < k <= len(days) and old[0, -1] == st["day"] == days[k - 1] and np.isclose(df['Close'].iat[k - 1], st["close"])): old = None
+        plan.append((t, df, days, old, len(df) - (old.shape[1] if old is not None else 0), st if old is not None else None))
+    if not plan: return {}
+    S = len(plan); L = max(min(len(p[1]), p[4] + INDICATOR_WARMUP) for p in plan)
+    close = np.full((L, S), np.nan); exists = np.zeros((L, S), dtype=bool)
+    for j, (t, df, days, old, n, st) in enumerate(plan):
+        m = min(len(df), n + INDICATOR_WARMUP)
+        close[L - m:, j] = df['Close'].to_numpy()[-m:]; exists[L - m:, j] = True
+    n_new = np.array([p[4] for p in plan])
+    seeds = np.array([[p[5][k] if p[5] else np.nan for p in plan] for k in ("ema12", "ema26", "signal")], dtype='float64')
+    print(f"   ↳ 指標引擎：{S} 支標的、面板 {L}x{S}、共新增 {int(n_new.sum())} 根 K 棒")
+    out, fin = compute_indicator_panel(close, exists, n_new, seeds)
+    frames = {}
+    for j, (t, df, days, old, n, st) in enumerate(plan):
+        vals = out[:, L - n:, j] if n else np.empty((len(INDICATOR_COLS), 0))
+        full = np.hstack([old[1:], vals]) if old is not None else vals
+        if n:
+            tmp = os.path.join(ind_root, f"{t}.tmp.npy")
+            np.save(tmp, np.vstack([days.astype('float64'), full])); os.replace(tmp, os.path.join(ind_root, f"{t}.npy"))
+            state[t] = {"day": int(days[-1]), "close": float(df['Close'].iat[-1]),
+                        "ema12": float(fin[0, j]), "ema26": float(fin[1, j]), "signal": float(fin[2, j])}
+        frames[t] = pd.concat([df, pd.DataFrame(full.T, index=df.index, columns=INDICATOR_COLS)], axis=1)
+    tmp = os.path.join(ind_root, "state.tmp.json")
+    with open(tmp, "w", encoding="utf-8") as f: json.dump(state, f)
+    os.replace(tmp, os.path.join(ind_root, "state.json"))
+    return frames
+
 # ==========================================
 # 3. 專業繪圖 (4K渲染、紅綠成交量、五段切換支持)
 # ==========================================
+CHART_PERIODS = [("1m", 21), ("3m", 63), ("6m", 126), ("1y", 252), ("max", 756)]
+
 def generate_chart(df_plot, is_1m=False):
     rows, height = (3, 800) if not is_1m else (1, 450)
     fig = make_subplots(rows=rows, cols=1, shared_xaxes=True, vertical_spacing=0.06, 
@@ -117,84 +460,573 @@ def generate_chart(df_plot, is_1m=False):
 
     fig.update_yaxes(range=[0, df_plot['Volume'].max()*1.8], secondary_y=True, showgrid=False, row=1)
     fig.update_layout(height=height, width=1050, template="plotly_dark", xaxis_rangeslider_visible=False, barmode='overlay', margin=dict(l=10, r=10, t=30, b=10))
-    return base64.b64encode(fig.to_image(format="png", scale=3)).decode('utf-8')
+    return fig
+
+def fetch_intraday(ticker):
+    df_intra_data = yf.download(ticker, period="1d", interval="1m", progress=False, prepost=True)
+    if df_intra_data.empty: return df_intra_data
+    if isinstance(df_intra_data.columns, pd.MultiIndex): df_intra_data.columns = df_intra_data.columns.get_level_values(0)
+    df_intra_data.index = df_intra_data.index.tz_convert('America/New_York')
+    df_intra_data['Vol_Avg'] = df_intra_data['Volume'].rolling(5, min_periods=1).mean()
+    return df_intra_data
+
+def _intraday_marks(df_intra_data):
+    """盤中標記：正規盤收盤點 (時間, 價格) 與成交量 > 5 分鐘均量 3 倍的前 10 大爆量 K 棒"""
+    reg = df_intra_data[df_intra_data.index.time <= datetime.time(16, 0)]
+    close_pt = (reg.index[-1], reg['Close'].iloc[-1]) if not reg.empty else None
+    spikes = df_intra_data[df_intra_data['Volume'] > df_intra_data['Vol_Avg']*3]
+    return close_pt, spikes.sort_values(by='Volume', ascending=False).head(10)
+
+def generate_intraday_chart(df_intra_data):
+    intra_vol_colors = ['rgba(0,255,0,0.7)' if r['Close'] >= r['Open'] else 'rgba(255,0,0,0.7)' for _, r in df_intra_data.iterrows()]
+    fig2 = make_subplots(specs=[[{"secondary_y": True}]])
+    fig2.add_trace(go.Bar(x=df_intra_data.index, y=df_intra_data['Volume'], marker=dict(color=intra_vol_colors, line_width=0), showlegend=False), secondary_y=True)
+    fig2.add_trace(go.Candlestick(x=df_intra_data.index, open=df_intra_data['Open'], high=df_intra_data['High'], low=df_intra_data['Low'], close=df_intra_data['Close']), secondary_y=False)
+    close_pt, spikes = _intraday_marks(df_intra_data)
+    if close_pt is not None:
+        ct, cp = close_pt
+        fig2.add_annotation(x=ct, y=cp, text="🔔 CLOSE (EST)", showarrow=True, arrowhead=2, font=dict(color="white", size=10), bgcolor="#003366", ay=-50)
+        fig2.add_shape(type="line", x0=df_intra_data.index[0], y0=cp, x1=df_intra_data.index[-1], y1=cp, line=dict(color="red", width=1.5, dash="dot"))
+    for idx, row in spikes.iterrows():
+        t_color = "lime" if row['Close'] > row['Open'] else "red"
+        fig2.add_annotation(x=idx, y=row['High'], text="▲ BUY" if row['Close'] > row['Open'] else "▼ SELL", showarrow=True, arrowhead=1, arrowcolor=t_color, font=dict(size=11, color=t_color, weight='bold'), bgcolor="black", opacity=0.9, ay=-40)
+    fig2.update_layout(height=450, width=1050, template="plotly_dark", xaxis_rangeslider_visible=False, margin=dict(l=10, r=10, t=30, b=10))
+    return fig2
+
+def generate_stock_figures(df_all, df_intra_data):
+    """五段日線 + 盤中共 6 張 Figure；盤中無資料時最後一張為 None"""
+    figs = [generate_chart(df_all.tail(n)) for _, n in CHART_PERIODS]
+    figs.append(generate_intraday_chart(df_intra_data) if not df_intra_data.empty else None)
+    return figs
+
+# ==========================================
+# 3.1 常駐渲染池 (kaleido 多行程、依序回傳、逐張逾時)
+# ==========================================
+_RENDER_POOL, _RENDER_GEN, _RENDER_LOCK = None, 0, threading.Lock()
+
+def _render_worker_init():
+    # 預熱：kaleido 第一次 to_image 會啟動 chromium 子行程，之後同一 worker 內常駐重用
+    try: pio.to_image(go.Figure(), format="png", width=10, height=10)
+    except Exception: pass
+
+def _render_asset(fig_dict):
+    # 在 worker 內直接寫入資產庫，只把檔名與本次量測 (牆鐘, CPU, worker RSS 高峰拉高量, worker RSS 高峰) 傳回主行程；
+    # kaleido 的瀏覽器子行程不在 CPU / 記憶體數字內
+    w0, c0, r0 = time.perf_counter(), time.process_time(), _peak_rss_mb()
+    name = save_asset(pio.to_image(fig_dict, format="png", scale=RENDER_SCALE), "png")
+    r1 = _peak_rss_mb()
+    return name, time.perf_counter() - w0, time.process_time() - c0, None if r1 is None else round(r1 - r0, 1), r1
+
+def get_render_pool(workers=None):
+    """回傳 (渲染池, 世代)，需要時 (首次或逾時被結束後) 建立新池。
+    worker 由 forkserver (無則 spawn) 產生而非直接 fork 本行程：重建時資料 / AI 執行緒仍在跑，fork 會把它們持有的鎖一起複製過去"""
+    global _RENDER_POOL
+    with _RENDER_LOCK:
+        if _RENDER_POOL is None:
+            ctx = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+            _RENDER_POOL = ProcessPoolExecutor(max_workers=workers or RENDER_WORKERS, mp_context=ctx, initializer=_render_worker_init)
+        return _RENDER_POOL, _RENDER_GEN
+
+def shutdown_render_pool(kill=False, gen=None):
+    """結束渲染池；指定 gen 時只結束該世代 (已被換掉則不動作)，避免同一次逾時連帶砍掉剛重建的新池"""
+    global _RENDER_POOL, _RENDER_GEN
+    with _RENDER_LOCK:
+        if gen is not None and gen != _RENDER_GEN: return
+        pool, _RENDER_POOL, _RENDER_GEN = _RENDER_POOL, None, _RENDER_GEN + 1
+    if pool is None: return
+    if kill:
+        # 卡住的 kaleido 無法用 cancel 中止，只能直接結束 worker，下次取用時重建
+        for p in list((pool._processes or {}).values()): p.terminate()
+    pool.shutdown(wait=not kill, cancel_futures=True)
+
+atexit.register(shutdown_render_pool)
+
+def warm_render_pool():
+    """管線開始前先啟動所有 worker 並預熱 kaleido，第一檔的圖表不必等 worker 冷啟動"""
+    if RENDER_WORKERS <= 1: return
+    pool, _ = get_render_pool()
+    for f in [pool.submit(time.sleep, 0.1) for _ in range(RENDER_WORKERS)]: f.result()
+
+def submit_figures(figs, workers=None):
+    """送出渲染工作並立即回傳工作清單 [fig dict, Future, 世代] (None 的位置保持 None)；workers <= 1 時在本行程同步渲染 (世代為 None)。
+    送出當下池剛好被結束時 Future 為 None，由 collect_figures 補送"""
+    workers = RENDER_WORKERS if workers is None else workers
+    jobs = []
+    for f in figs:
+        if f is None: jobs.append(None); continue
+        d, fut = f.to_dict(), Future()
+        if workers > 1:
+            pool, gen = get_render_pool(workers)
+            try: fut = pool.submit(_render_asset, d)
+            except (BrokenExecutor, RuntimeError): fut = None  # 送出當下池剛被結束
+            jobs.append([d, fut, gen]); continue
+        try: fut.set_result(_render_asset(d))
+        except Exception as e: fut.set_exception(e)
+        jobs.append([d, fut, None])
+    return jobs
+
+def _collect_one(job, timeout):
+    d, fut, gen = job
+    for attempt in range(2):
+        # 送出後所屬的池已被結束 (其他圖逾時) 且尚未成功完成：改送到目前的池，而不是當成失敗
+        done_ok = fut is not None and fut.done() and not fut.cancelled() and fut.exception() is None
+        if fut is None or (gen is not None and gen != _RENDER_GEN and not done_ok):
+            pool, gen = get_render_pool(); fut = pool.submit(_render_asset, d)
+        try: return fut.result(timeout=timeout)
+        except FutureTimeout: shutdown_render_pool(kill=True, gen=gen); raise
+        except (BrokenExecutor, CancelledError):
+            # 等待中池被結束或 worker 崩潰：只結束該世代，再重送一次
+            shutdown_render_pool(kill=True, gen=gen); fut = None
+            if attempt: raise
+
+def collect_figures(jobs, timeout=None, ticker=None):
+    """依序取回 PNG 資產檔名；逾時或失敗的位置回傳 None。逾時只結束該圖所屬世代的渲染池，
+    同池中其他仍在途的圖會重送到新池。每張圖在 worker 內的耗時記為 to_image，主行程在此等待的時間記為 render_wait"""
+    timeout = RENDER_TIMEOUT if timeout is None else timeout
+    out = [None] * len(jobs)
+    with PROFILER.stage("render_wait", ticker):
+        for i, job in enumerate(jobs):
+            if job is None: continue
+            try: out[i], *m = _collect_one(job, timeout); PROFILER.add("to_image", ticker, *m)
+            except FutureTimeout: print(f"⚠️ 圖表渲染逾時 ({ticker or ''}#{i}, >{timeout}s)"); PROFILER.add("to_image", ticker, error=f"逾時 >{timeout}s")
+            except BrokenExecutor as e: print(f"⚠️ 渲染池中斷 ({ticker or ''}#{i}): {e}"); PROFILER.add("to_image", ticker, error=e)
+            except Exception as e: print(f"⚠️ 圖表渲染失敗 ({ticker or ''}#{i}): {e}"); PROFILER.add("to_image", ticker, error=e)
+    return out
+
+def render_figures(figs, workers=None, timeout=None, ticker=None):
+    """把 Figure 清單渲染成 PNG 資產，檔名依輸入順序回傳；None、逾時或失敗的位置回傳 None"""
+    return collect_figures(submit_figures(figs, workers), timeout, ticker)
+
+# ==========================================
+# 3.2 前端繪圖模式 (每檔只輸出一次精簡 JSON，由 plotly.js 在瀏覽器切片繪製)
+# ==========================================
+CHART_FIELDS = [("o", "Open", 4), ("h", "High", 4), ("l", "Low", 4), ("c", "Close", 4), ("v", "Volume", 0),
+                ("s20", "SMA20", 4), ("s50", "SMA50", 4), ("s200", "SMA200", 4),
+                ("m", "MACD", 4), ("sg", "Signal", 4), ("hi", "Hist", 4), ("r", "RSI", 2)]
+
+PLOTLY_JS_URL = "https://cdn.plot.ly/plotly-finance-2.35.2.min.js"
+CLIENT_CHART_JS = """
+const PERIOD_BARS = { '1m': 21, '3m': 63, '6m': 126, '1y': 252, 'max': 756 };
+const CHART_CACHE = {};
+const DARK = { paper_bgcolor: '#111111', plot_bgcolor: '#111111', font: { color: '#f2f5fa' }, margin: { l: 10, r: 10, t: 30, b: 10 } };
+const AXIS = { gridcolor: '#283442', zerolinecolor: '#283442', automargin: true };
+function chartData(t) {
+    // 圖表資料是獨立的資產檔，第一次需要時才下載，之後切換區間只重新切片
+    if (!CHART_CACHE[t]) CHART_CACHE[t] = fetch(document.getElementById('chart-' + t).dataset.src).then(r => r.json());
+    return CHART_CACHE[t];
+}
+function upDown(o, c, alpha) { return c.map((v, i) => v >= o[i] ? `rgba(0,255,0,${alpha})` : `rgba(255,0,0,${alpha})`); }
+function chartHeight(el, h) { return Math.round((el.clientWidth || 1050) * h / 1050); }
+async function drawPeriod(t, period) {
+    const D = await chartData(t), n = PERIOD_BARS[period], el = document.getElementById('chart-' + t);
+    const s = k => D[k].slice(Math.max(D[k].length - n, 0)), x = s('d'), o = s('o'), c = s('c'), v = s('v'), hist = s('hi');
+    const traces = [
+        { type: 'bar', x: x, y: v, yaxis: 'y2', marker: { color: upDown(o, c, 0.7), line: { width: 0 } }, showlegend: false },
+        { type: 'candlestick', x: x, open: o, high: s('h'), low: s('l'), close: c, name: 'Price' },
+        { type: 'scatter', x: x, y: s('s20'), line: { color: 'cyan', width: 1.5 }, name: 'MA20' },
+        { type: 'scatter', x: x, y: s('s50'), line: { color: 'orange', width: 1.8 }, name: 'MA50' },
+        { type: 'scatter', x: x, y: s('s200'), line: { color: 'yellow', width: 2.5 }, name: 'MA200' },
+        { type: 'bar', x: x, y: hist, xaxis: 'x2', yaxis: 'y3', marker: { color: hist.map(h => h >= 0 ? 'rgba(0,255,0,0.9)' : 'rgba(255,0,0,0.9)'), line: { width: 0 } }, name: 'Hist' },
+        { type: 'scatter', x: x, y: s('m'), xaxis: 'x2', yaxis: 'y3', line: { color: '#00FF00', width: 2 }, name: 'MACD' },
+        { type: 'scatter', x: x, y: s('sg'), xaxis: 'x2', yaxis: 'y3', line: { color: '#A020F0', width: 2 }, name: 'Signal' },
+        { type: 'scatter', x: x, y: s('r'), xaxis: 'x3', yaxis: 'y4', line: { color: '#E0B0FF', width: 2.5 }, name: 'RSI' }
+    ];
+    const layout = Object.assign({}, DARK, {
+        height: chartHeight(el, 800), barmode: 'overlay',
+        xaxis: Object.assign({ anchor: 'y', rangeslider: { visible: false }, tickfont: { size: 10, color: 'gray' } }, AXIS),
+        xaxis2: Object.assign({ anchor: 'y3', matches: 'x', showticklabels: false }, AXIS),
+        xaxis3: Object.assign({ anchor: 'y4', matches: 'x', showticklabels: false }, AXIS),
+        yaxis: Object.assign({ domain: [0.56, 1] }, AXIS),
+        yaxis2: { overlaying: 'y', side: 'right', showgrid: false, range: [0, Math.max(...v) * 1.8] },
+        yaxis3: Object.assign({ domain: [0.2536, 0.5] }, AXIS),
+        yaxis4: Object.assign({ domain: [0, 0.1936] }, AXIS)
+    });
+    Plotly.react(el, traces, layout, { displayModeBar: false, responsive: true });
+}
+async function drawIntraday(t) {
+    const I = (await chartData(t)).i, el = document.getElementById('intra-' + t);
+    if (!I) { el.style.display = 'none'; return; }
+    const layout = Object.assign({}, DARK, {
+        height: chartHeight(el, 450), shapes: [], annotations: [],
+        xaxis: Object.assign({ rangeslider: { visible: false }, tickfont: { size: 10, color: 'gray' } }, AXIS),
+        yaxis: AXIS, yaxis2: { overlaying: 'y', side: 'right', showgrid: false }
+    });
+    if (I.close) {
+        layout.annotations.push({ x: I.close[0], y: I.close[1], text: '🔔 CLOSE (EST)', showarrow: true, arrowhead: 2, font: { color: 'white', size: 10 }, bgcolor: '#003366', ay: -50 });
+        layout.shapes.push({ type: 'line', x0: I.t[0], x1: I.t[I.t.length - 1], y0: I.close[1], y1: I.close[1], line: { color: 'red', width: 1.5, dash: 'dot' } });
+    }
+    I.spk.forEach(([x, y, buy]) => {
+        const color = buy ? 'lime' : 'red';
+        layout.annotations.push({ x: x, y: y, text: buy ? '▲ BUY' : '▼ SELL', showarrow: true, arrowhead: 1, arrowcolor: color, font: { size: 11, color: color }, bgcolor: 'black', opacity: 0.9, ay: -40 });
+    });
+    Plotly.react(el, [
+        { type: 'bar', x: I.t, y: I.v, yaxis: 'y2', marker: { color: upDown(I.o, I.c, 0.7), line: { width: 0 } }, showlegend: false },
+        { type: 'candlestick', x: I.t, open: I.o, high: I.h, low: I.l, close: I.c, name: 'Price' }
+    ], layout, { displayModeBar: false, responsive: true });
+}
+document.addEventListener('DOMContentLoaded', () => {
+    // 卡片捲入視窗時才下載資料並繪圖，避免一次畫數十張圖拖慢手機
+    const io = new IntersectionObserver(entries => entries.forEach(e => {
+        if (!e.isIntersecting) return;
+        io.unobserve(e.target); drawPeriod(e.target.id, '1y'); drawIntraday(e.target.id);
+    }), { rootMargin: '600px' });
+    document.querySelectorAll('.stock-card').forEach(c => io.observe(c));
+});
+"""
+
+def _compact(values, nd):
+    return [None if v != v else (round(v, nd) if nd else int(v)) for v in np.asarray(values, dtype='float64').tolist()]
+
+def build_chart_payload(df_all, df_intra_data):
+    """把日線指標 (最多 MAX 段長度) 與盤中資料壓成單一 JSON 字串"""
+    d = df_all.tail(CHART_PERIODS[-1][1])
+    payload = {"d": d.index.strftime("%Y-%m-%d").tolist()}
+    for key, col, nd in CHART_FIELDS: payload[key] = _compact(d[col], nd)
+    if not df_intra_data.empty:
+        close_pt, spikes = _intraday_marks(df_intra_data)
+        fmt = lambda ts: ts.strftime("%Y-%m-%dT%H:%M")
+        intra = {"t": [fmt(ts) for ts in df_intra_data.index]}
+        for key, col, nd in CHART_FIELDS[:5]: intra[key] = _compact(df_intra_data[col], nd)
+        intra["close"] = [fmt(close_pt[0]), round(float(close_pt[1]), 4)] if close_pt is not None else None
+        intra["spk"] = [[fmt(idx), round(float(r['High']), 4), int(r['Close'] > r['Open'])] for idx, r in spikes.iterrows()]
+        payload["i"] = intra
+    return json.dumps(payload, separators=(",", ":"))
+
+# ==========================================
+# 3.3 內容定址資產庫 (以內容雜湊命名，多份報告共用同一檔案)
+# ==========================================
+def save_asset(data, ext):
+    """寫入 assets/<sha256 前 20 碼>.<ext> 並回傳檔名；內容相同的檔案已存在時直接沿用"""
+    name = f"{hashlib.sha256(data).hexdigest()[:20]}.{ext}"
+    path = os.path.join(ASSET_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(ASSET_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f: f.write(data)
+        os.replace(tmp, path)
+    return name
+
+# ==========================================
+# 4. 批量 AI 分析 (Gemini 3 Flash；令牌桶限速、自適應批次、磁碟快取)
+# ==========================================
+AI_PROMPT = "分析美股技術趨勢，提供 150-200 字建議。繁體中文。回傳 JSON：{{\"Ticker\": \"內容\"}} \n數據：\n{summary}"
+AI_FALLBACK = "⚠️ 分析產出中..."
+AI_NO_KEY = "❌ 無 API"
+
+class TokenBucket:
+    """非同步令牌桶：每分鐘補充 rpm 個令牌；burst 預設 1，讓請求平均分散避免撞到每分鐘配額"""
+    def __init__(self, rpm, burst=1):
+        self.rate, self.capacity = rpm / 60.0, burst
+        self.tokens, self.stamp, self.lock = float(burst), time.monotonic(), asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate); self.stamp = now
+                if self.tokens >= 1: self.tokens -= 1; return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class FakeGeminiClient:
+    """離線替身，介面同 genai.Client(...).aio.models.generate_content；依 prompt 內的代碼回傳固定內容的 JSON"""
+    def __init__(self, text="<b>【測試診斷】</b>：正在測試漲幅過濾(<20%)與市值限制(>100M)。", delay=0.0):
+        self.text, self.delay, self.calls = text, delay, 0
+        self.aio = self.models = self
+
+    async def generate_content(self, model, contents):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        tickers = re.findall(r"^- ([^:\s]+):", contents, re.M)
+        return types.SimpleNamespace(text="```json\n" + json.dumps({t: self.text for t in tickers}, ensure_ascii=False) + "\n```")
+
+def _summary_line(r):
+    return f"- {r['Ticker']}: ${r['Price']} ({r['Change']}%) [{r['Industry']}] MC: {r['MarketCap']}\n"
+
+def _insight_key(r, day):
+    # 代碼 + 交易日 + 輸入內容雜湊：價格、模型或 prompt 有變就不會誤用舊結果
+    digest = hashlib.sha1(f"{TARGET_MODEL}|{AI_PROMPT}|{_summary_line(r)}".encode("utf-8")).hexdigest()[:12]
+    return f"{r['Ticker']}|{day}|{digest}"
 
-def generate_stock_images(ticker):
+def _load_ai_cache(day):
+    path = os.path.join(AI_CACHE_DIR, f"{day}.json")
+    if not os.path.exists(path): return {}
     try:
-        df_all = yf.download(ticker, period="4y", interval="1d", progress=False)
-        if df_all.empty: return [None]*7
-        if isinstance(df_all.columns, pd.MultiIndex): df_all.columns = df_all.columns.get_level_values(0)
-        df_all = df_all.ffill()
-        df_all['SMA20']=df_all['Close'].rolling(20, min_periods=1).mean(); df_all['SMA50']=df_all['Close'].rolling(50, min_periods=1).mean(); df_all['SMA200']=df_all['Close'].rolling(200, min_periods=1).mean()
-        exp1=df_all['Close'].ewm(span=12, adjust=False).mean(); exp2=df_all['Close'].ewm(span=26, adjust=False).mean()
-        df_all['MACD']=exp1-exp2; df_all['Signal']=df_all['MACD'].ewm(span=9, adjust=False).mean(); df_all['Hist']=df_all['MACD']-df_all['Signal']
-        delta=df_all['Close'].diff(); g=delta.where(delta>0,0).rolling(14, min_periods=1).mean(); l=-delta.where(delta<0,0).rolling(14, min_periods=1).mean()
-        df_all['RSI']=100-(100/(1+g/l))
-
-        img_1m = generate_chart(df_all.tail(21))
-        img_3m = generate_chart(df_all.tail(63))
-        img_6m = generate_chart(df_all.tail(126))
-        img_1y = generate_chart(df_all.tail(252))
-        img_max = generate_chart(df_all.tail(min(len(df_all), 756)))
-
-        df_intra_data = yf.download(ticker, period="1d", interval="1m", progress=False, prepost=True)
-        img_intra = ""
-        if not df_intra_data.empty:
-            if isinstance(df_intra_data.columns, pd.MultiIndex): df_intra_data.columns = df_intra_data.columns.get_level_values(0)
-            df_intra_data.index = df_intra_data.index.tz_convert('America/New_York')
-            df_intra_data['Vol_Avg'] = df_intra_data['Volume'].rolling(5, min_periods=1).mean()
-            intra_vol_colors = ['rgba(0,255,0,0.7)' if r['Close'] >= r['Open'] else 'rgba(255,0,0,0.7)' for _, r in df_intra_data.iterrows()]
-            fig2 = make_subplots(specs=[[{"secondary_y": True}]])
-            fig2.add_trace(go.Bar(x=df_intra_data.index, y=df_intra_data['Volume'], marker=dict(color=intra_vol_colors, line_width=0), showlegend=False), secondary_y=True)
-            fig2.add_trace(go.Candlestick(x=df_intra_data.index, open=df_intra_data['Open'], high=df_intra_data['High'], low=df_intra_data['Low'], close=df_intra_data['Close']), secondary_y=False)
-            reg = df_intra_data[df_intra_data.index.time <= datetime.time(16, 0)]
-            if not reg.empty:
-                cp=reg.iloc[-1]; ct=reg.index[-1]
-                fig2.add_annotation(x=ct, y=cp['Close'], text="🔔 CLOSE (EST)", showarrow=True, arrowhead=2, font=dict(color="white", size=10), bgcolor="#003366", ay=-50)
-                fig2.add_shape(type="line", x0=df_intra_data.index[0], y0=cp['Close'], x1=df_intra_data.index[-1], y1=cp['Close'], line=dict(color="red", width=1.5, dash="dot"))
-            spikes = df_intra_data[df_intra_data['Volume'] > df_intra_data['Vol_Avg']*3].copy()
-            for idx, row in spikes.sort_values(by='Volume', ascending=False).head(10).iterrows():
-                t_color = "lime" if row['Close'] > row['Open'] else "red"
-                fig2.add_annotation(x=idx, y=row['High'], text="▲ BUY" if row['Close'] > row['Open'] else "▼ SELL", showarrow=True, arrowhead=1, arrowcolor=t_color, font=dict(size=11, color=t_color, weight='bold'), bgcolor="black", opacity=0.9, ay=-40)
-            fig2.update_layout(height=450, width=1050, template="plotly_dark", xaxis_rangeslider_visible=False, margin=dict(l=10, r=10, t=30, b=10))
-            img_intra = base64.b64encode(fig2.to_image(format="png", scale=3)).decode('utf-8')
-            
-        return img_1m, img_3m, img_6m, img_1y, img_max, img_intra, bool(df_all['Close'].iloc[-1] > df_all['SMA200'].iloc[-1])
-    except: return [None]*7
+        with open(path, encoding="utf-8") as f: return json.load(f)
+    except ValueError: return {}
+
+def _save_ai_cache(day, cache):
+    os.makedirs(AI_CACHE_DIR, exist_ok=True); path = os.path.join(AI_CACHE_DIR, f"{day}.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f: json.dump(cache, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def parse_insights(raw, tickers):
+    """解析模型回傳；整段 JSON 壞掉 (被截斷、夾雜文字) 時逐一擷取完整的 "TICKER": "..." 片段"""
+    text = (raw or "").strip().replace('```json', '').replace('```', '')
+    a, b = text.find('{'), text.rfind('}')
+    try: obj = json.loads(text[a:b+1]) if 0 <= a < b else {}
+    except ValueError: obj = {}
+    out = {t: str(v) for t, v in obj.items() if t in tickers and v} if isinstance(obj, dict) else {}
+    for t in tickers:
+        if t in out: continue
+        m = re.search(r'"%s"\s*:\s*"((?:[^"\\]|\\.)*)"' % re.escape(t), text, re.S)
+        if not m: continue
+        try: out[t] = json.loads(f'"{m.group(1)}"')
+        except ValueError: out[t] = m.group(1)
+    return out
+
+async def _ask_gemini(client, bucket, rows):
+    """單批請求，失敗時指數退避重試；全部失敗回傳 None，格式問題回傳部分結果"""
+    tickers = [r['Ticker'] for r in rows]
+    prompt = AI_PROMPT.format(summary="".join(_summary_line(r) for r in rows))
+    for attempt in range(GEMINI_RETRIES):
+        await bucket.acquire()
+        try:
+            # 只計請求本身 (不含令牌桶等待)；同一事件迴圈上的其他批次也會算進這段的 CPU 時間
+            with PROFILER.stage("gemini"): resp = await client.aio.models.generate_content(model=TARGET_MODEL, contents=prompt)
+            return parse_insights(resp.text, tickers)
+        except Exception as e:
+            delay = min(60, 5 * 2 ** attempt) * (0.5 + random.random())
+            print(f"⚠️ Gemini 失敗 ({','.join(tickers)}) 第 {attempt+1} 次: {e}，{delay:.0f}s 後重試")
+            await asyncio.sleep(delay)
+    return None
+
+async def _schedule_insights(client, rows, rpm, on_batch):
+    bucket = TokenBucket(rpm)
+    # 批次大小：讓全部標的約在一分鐘配額內送完，上限 GEMINI_MAX_BATCH 以免回應被截斷
+    size = max(1, min(GEMINI_MAX_BATCH, math.ceil(len(rows) / max(rpm, 1))))
+
+    async def run(batch):
+        got = await _ask_gemini(client, bucket, batch)
+        if got is None: return
+        on_batch(got)
+        missing = [r for r in batch if r['Ticker'] not in got]
+        # 回應缺漏時拆半重送，批次自動縮小直到單一標的
+        if missing and len(batch) > 1:
+            half = max(1, len(missing) // 2)
+            await asyncio.gather(run(missing[:half]), *([run(missing[half:])] if missing[half:] else []))
+
+    await asyncio.gather(*(run(rows[i:i+size]) for i in range(0, len(rows), size)))
+
+def get_ai_insights(df, client=None, rpm=None, on_result=None, day=None):
+    """回傳 {ticker: 分析}。先讀磁碟快取，未命中的交給非同步排程器；on_result(ticker, text) 於每筆完成時呼叫"""
+    tickers = df['Ticker'].tolist()
+    if client is None:
+        if TEST_MODE: client, rpm = FakeGeminiClient(), rpm or 6000
+        elif not GEMINI_KEY: return {t: AI_NO_KEY for t in tickers}
+        else:
+            try: client = genai.Client(api_key=GEMINI_KEY)
+            except Exception as e: print(f"❌ Gemini 初始化失敗: {e}"); return {t: AI_FALLBACK for t in tickers}
+    day = day or _today_ny().isoformat()
+    cache = _load_ai_cache(day); rows = df.to_dict('records')
+    keys = {r['Ticker']: _insight_key(r, day) for r in rows}
+    insights = {t: cache[k] for t, k in keys.items() if k in cache}
+    pending = [r for r in rows if r['Ticker'] not in insights]
+    print(f"   ↳ AI 快取命中 {len(insights)} 支，待分析 {len(pending)} 支")
+    if on_result:
+        for t, v in insights.items(): on_result(t, v)
+
+    def on_batch(got):
+        for t, v in got.items():
+            insights[t] = cache[keys[t]] = v
+            if on_result: on_result(t, v)
+        _save_ai_cache(day, cache)
+
+    if pending: asyncio.run(_schedule_insights(client, pending, rpm or GEMINI_RPM, on_batch))
+    for t in tickers:
+        if t not in insights:
+            insights[t] = AI_FALLBACK
+            if on_result: on_result(t, AI_FALLBACK)
+    return insights
+
+# ==========================================
+# 4.1 執行紀錄 (以交易日為鍵，逐檔逐階段記錄狀態，供中斷續跑與重試失敗標的)
+# ==========================================
+class RunJournal:
+    """data/runs/<交易日>.json：篩選結果與每檔 data / indicators / images / insight 各階段的狀態、錯誤與產出"""
+    def __init__(self, day, path=None, state=None):
+        self.day, self.path = day, path
+        self.state = state or {"day": day, "screen": None, "tickers": {}}
+        self.lock, self.saved = threading.RLock(), 0.0
+
+    @classmethod
+    def load(cls, day, root=None):
+        path, state = os.path.join(root or JOURNAL_DIR, f"{day}.json"), None
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f: state = json.load(f)
+        return cls(day, path, state)
+
+    def screen(self):
+        rows = self.state.get("screen")
+        return pd.DataFrame(rows) if rows else None
+
+    def set_screen(self, df):
+        with self.lock: self.state["screen"] = df.to_dict('records')
+        self.flush()
+
+    def get(self, ticker, stage):
+        return self.state["tickers"].get(ticker, {}).get(stage)
+
+    def record(self, ticker, stage, ok, error=None, **result):
+        entry = dict(result, status="ok" if ok else "failed", at=datetime.datetime.now(pytz.utc).isoformat(timespec="seconds"))
+        if error: entry["error"] = str(error)[:500]
+        with self.lock:
+            self.state["tickers"].setdefault(ticker, {})[stage] = entry
+            due = time.monotonic() - self.saved > JOURNAL_FLUSH_SECS
+        if due: self.flush()
+
+    CHART_STAGES = ("data", "indicators", "images")
+
+    def failed(self, ticker, stages=CHART_STAGES):
+        # 預設只看產生圖表的各階段；AI 分析與其並行且可單獨重試，以 stages=("insight",) 另外查詢
+        entries = self.state["tickers"].get(ticker, {})
+        return any(entries[s]["status"] == "failed" for s in stages if s in entries)
+
+    def finished(self, ticker):
+        # 圖表階段已有結果，或前段已失敗而不會再往下走 (不看 insight：它可能在圖表完成前就先記錄)
+        return self.get(ticker, "images") is not None or self.failed(ticker)
+
+    def flush(self):
+        if not self.path: return
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f: json.dump(self.state, f, ensure_ascii=False)
+            os.replace(self.path + ".tmp", self.path); self.saved = time.monotonic()
 
 # ==========================================
-# 4. 批量 AI 分析 (Gemini 3 Flash)
+# 4.2 串流管線 (資料/指標 → 渲染 → 寫檔，AI 分析並行；階段間以有界佇列銜接)
 # ==========================================
-def get_batch_ai_insights(df_subset):
-    tickers = df_subset['Ticker'].tolist()
-    if TEST_MODE: return {t: f"<b>【測試診斷】</b>：正在測試漲幅過濾(<20%)與市值限制(>100M)。" for t in tickers}
-    if not GEMINI_KEY: return {t: "❌ 無 API" for t in tickers}
-    summary = "".join([f"- {r['Ticker']}: ${r['Price']} ({r['Change']}%) [{r['Industry']}] MC: {r['MarketCap']}\n" for _, r in df_subset.iterrows()])
-    prompt = f"分析美股技術趨勢，提供 150-200 字建議。繁體中文。回傳 JSON：{{\"Ticker\": \"內容\"}} \n數據：\n{summary}"
+def _data_stage(tickers, q_out, journal):
+    """每 PIPELINE_CHUNK 支批次下載並計算指標面板，再逐檔附上盤中資料往下游送；失敗的標的以 None 佔位以維持順序"""
+    try:
+        for i in range(0, len(tickers), PIPELINE_CHUNK):
+            chunk = tickers[i:i+PIPELINE_CHUNK]
+            errors = update_ohlcv_store(chunk)
+            for t in chunk: journal.record(t, "data", t not in errors, errors.get(t))
+            ready = [t for t in chunk if t not in errors]
+            try: frames, err = update_indicator_store(ready), "指標計算無結果"
+            except Exception as e: print(f"⚠️ 指標批次失敗 ({chunk[0]}…): {e}"); frames, err = {}, e
+            for t in ready: journal.record(t, "indicators", t in frames, None if t in frames else err)
+            for t in chunk:
+                df_all, df_intra_data = frames.pop(t, None), pd.DataFrame()
+                if df_all is not None:
+                    try:
+                        with PROFILER.stage("intraday", t): df_intra_data = fetch_intraday(t)
+                    except Exception as e: print(f"⚠️ {t} 盤中資料失敗: {e}")
+                q_out.put((t, df_all, df_intra_data))
+    finally: q_out.put(None)
+
+def _render_stage(q_in, q_out):
+    """png 模式建好 Figure 後只送進渲染池、不等結果；client 模式直接輸出 JSON"""
     try:
-        client = genai.Client(api_key=GEMINI_KEY); resp = client.models.generate_content(model=TARGET_MODEL, contents=prompt)
-        raw = resp.text.strip().replace('```json', '').replace('```', '')
-        time.sleep(60); return json.loads(raw)
-    except: return {t: "⚠️ 分析產出中..." for t in tickers}
+        while (item := q_in.get()) is not None:
+            t, df_all, df_intra_data = item; media = is_a = err = None
+            if df_all is None: q_out.put((t, None, None, None)); continue
+            try:
+                is_a = bool(df_all['Close'].iloc[-1] > df_all['SMA200'].iloc[-1])
+                if CHART_MODE == "client":
+                    with PROFILER.stage("payload", t): media = save_asset(build_chart_payload(df_all, df_intra_data).encode("utf-8"), "json")
+                else:
+                    with PROFILER.stage("figures", t): figs = generate_stock_figures(df_all, df_intra_data)
+                    media = submit_figures(figs)
+            except Exception as e: print(f"⚠️ {t} 圖表建立失敗: {e}"); err = e
+            q_out.put((t, media, is_a, err))
+    finally: q_out.put(None)
+
+def _insight_stage(df, futures, journal):
+    """AI 分析只依賴篩選結果，與資料 / 渲染同時進行；每完成一檔就記錄並解除寫檔端的等待"""
+    def on_result(t, v):
+        if t not in futures or futures[t].done(): return
+        # 未設定 API 金鑰不算失敗也不記錄：設定金鑰後重跑會自動補問
+        if v != AI_NO_KEY:
+            ok = v != AI_FALLBACK
+            journal.record(t, "insight", ok, None if ok else v, text=v)
+        futures[t].set_result(v)
+    res = {}
+    try: res = get_ai_insights(df, on_result=on_result)
+    except Exception as e: print(f"⚠️ AI 分析中斷: {e}")
+    finally:
+        for t in df['Ticker']: on_result(t, res.get(t, AI_FALLBACK))
+
+def _cached_images(entry):
+    """紀錄中的圖表仍可沿用：成功、同一繪圖模式且資產檔都還在"""
+    if not entry or entry["status"] != "ok" or entry.get("mode") != CHART_MODE: return None
+    media = entry["media"]
+    names = media if isinstance(media, list) else [media]
+    if not all(os.path.exists(os.path.join(ASSET_DIR, m)) for m in names if m): return None
+    return tuple(media) if isinstance(media, list) else media
+
+def run_pipeline(df, journal, retry_failed=False):
+    """依篩選順序逐檔產出 (ticker, media, is_above, insight)；media 為 None 表示沒有圖表。
+    紀錄中圖表已完成的標的直接沿用；retry_failed 時重跑圖表階段失敗的標的，AI 分析失敗者只重新詢問 Gemini。"""
+    tickers = df['Ticker'].tolist()
+    cached, todo = {}, []
+    for t in tickers:
+        if not journal.finished(t) or (retry_failed and journal.failed(t)): todo.append(t); continue
+        cached[t] = _cached_images(journal.get(t, "images"))
+        if cached[t] is None and not journal.failed(t): todo.append(t)  # 成功過但資產檔遺失或模式已切換
+    insights, ask = {t: Future() for t in tickers}, []
+    for t in tickers:
+        e = journal.get(t, "insight")
+        if e is None or (retry_failed and e["status"] == "failed"): ask.append(t)
+        else: insights[t].set_result(e.get("text") or AI_FALLBACK)
+    print(f"   ↳ 執行紀錄：沿用 {len(tickers) - len(todo)} 支、待處理 {len(todo)} 支、待 AI 分析 {len(ask)} 支")
+    if todo and CHART_MODE != "client": warm_render_pool()
+    q_data, q_cards = queue.Queue(PIPELINE_QUEUE), queue.Queue(PIPELINE_QUEUE)
+    stages = [(_data_stage, (todo, q_data, journal)), (_render_stage, (q_data, q_cards))]
+    if ask: stages.append((_insight_stage, (df[df['Ticker'].isin(ask)], insights, journal)))
+    for target, args in stages: threading.Thread(target=target, args=args, daemon=True).start()
+    todo_set, drained = set(todo), False
+    for t in tickers:
+        if t not in todo_set:
+            yield t, cached.get(t), (journal.get(t, "images") or {}).get("is_above"), insights[t].result(); continue
+        # 各階段皆單執行緒 FIFO，q_cards 的順序與 todo 相同；階段異常結束時不再等待
+        item = None if drained else q_cards.get()
+        if item is None:
+            drained = True; yield t, None, None, insights[t].result(); continue
+        _, media, is_a, err = item
+        if media is not None and CHART_MODE != "client":
+            imgs = collect_figures(media, ticker=t)
+            media, err = (tuple(imgs), None) if imgs[3] else (None, "圖表渲染失敗或逾時")
+        if is_a is not None or err is not None:
+            journal.record(t, "images", media is not None, err, media=list(media) if isinstance(media, tuple) else media, is_above=is_a, mode=CHART_MODE)
+        yield t, media, is_a, insights[t].result()
+    journal.flush()
 
 # ==========================================
 # 5. HTML 生成 (歷史、導航、五段切換)
 # ==========================================
-def create_html_report(df):
+def update_history_manifest(report_file, path="history/manifest.json"):
+    """把當日報告加入共用的存檔清單 (新到舊)；首次建立時由既有的 history/report_*.html 補齊"""
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f: files = [r["file"] for r in json.load(f)["reports"]]
+    else: files = [os.path.basename(p) for p in glob.glob("history/report_*.html")]
+    files = sorted(set(files) | {report_file}, reverse=True)
+    reports = [{"date": f"{f[7:11]}-{f[11:13]}-{f[13:15]}", "file": f} for f in files]
+    with open(path + ".tmp", "w", encoding="utf-8") as f: json.dump({"updated": datetime.datetime.now(pytz.utc).isoformat(timespec="seconds"), "reports": reports}, f, ensure_ascii=False, indent=1)
+    os.replace(path + ".tmp", path)
+
+def profile_footer(prof):
+    """報告頁尾：可展開的各階段耗時表，完整剖析結果以 JSON 內嵌 (id="run-profile") 供事後擷取"""
+    mb = lambda v: "" if v is None else v
+    rows = "".join(f"<tr><td>{k}</td><td>{s['n']}</td><td>{s['wall']:.2f}</td><td>{s['cpu']:.2f}</td><td>{s['max']:.2f}</td><td>{mb(s['growth'])}</td><td>{mb(s['peak_so_far'])}</td><td>{s['errors'] or ''}</td></tr>"
+                   for k, s in sorted(prof["stages"].items(), key=lambda kv: -kv[1]["wall"]))
+    data = json.dumps(prof, ensure_ascii=False, separators=(",", ":")).replace("</", "<\\/")
+    return f"""<details style="background:white;border-radius:8px;padding:10px 15px;margin-bottom:20px;font-size:12px;color:#666;"><summary>⏱️ 執行剖析：總耗時 {prof['elapsed']:.1f}s，行程 RSS 高峰 {prof['peak_rss_mb']} MB</summary>
+        <table class="summary-table" style="min-width:0;margin:10px 0 0;"><thead><tr><th>階段</th><th>次數</th><th>牆鐘 (s)</th><th>CPU (s)</th><th>單次最長 (s)</th><th>期間拉高 RSS 高峰 (MB)</th><th>結束時行程 RSS 高峰 (MB)</th><th>失敗</th></tr></thead><tbody>{rows}</tbody></table></details>
+        <script type="application/json" id="run-profile">{data}</script>"""
+
+def create_html_report(df, journal=None, retry_failed=False):
     ny_tz = pytz.timezone('America/New_York'); today_ny = datetime.datetime.now(ny_tz).strftime("%Y-%m-%d")
     today_str = datetime.date.today().strftime("%Y%m%d")
-    os.makedirs("history", exist_ok=True); history_files = sorted(glob.glob("history/report_*.html"), reverse=True)
-    
-    l_main = "".join([f'<a href="./history/report_{f.split("_")[1][:8]}.html" class="history-item">{f.split("_")[1][:4]}-{f.split("_")[1][4:6]}-{f.split("_")[1][6:8]}</a>' for f in history_files])
-    l_hist = "".join([f'<a href="./report_{f.split("_")[1][:8]}.html" class="history-item">{f.split("_")[1][:4]}-{f.split("_")[1][4:6]}-{f.split("_")[1][6:8]}</a>' for f in history_files])
-    
+    os.makedirs("history", exist_ok=True)
+    journal = journal or RunJournal.load(_today_ny().isoformat())
+
     def get_nav(is_m):
+        # 存檔清單由 history/manifest.json 在瀏覽器端載入，舊報告也會看到之後新增的日期
         h = "" if is_m else '<a href="../index.html" class="history-item" style="background:#003366;color:white;font-weight:bold;">🏠 返回最新</a>'
-        return f'<div class="history-bar"><div style="font-weight:bold;margin-right:10px;color:#003366;white-space:nowrap;">📅 存檔：</div>{h}{l_main if is_m else l_hist}</div>'
+        return f'<div class="history-bar" data-base="{"./history/" if is_m else "./"}"><div style="font-weight:bold;margin-right:10px;color:#003366;white-space:nowrap;">📅 存檔：</div>{h}</div>'
 
-    all_insights = {}
-    print(f">>> [步驟 2] 開始深度分析 (共 {len(df)} 支符合門檻之股票)...")
-    for i in range(0, len(df), 2): all_insights.update(get_batch_ai_insights(df.iloc[i:i+2]))
+    client_js = f'<script src="{PLOTLY_JS_URL}" charset="utf-8" defer></script><script>{CLIENT_CHART_JS}</script>' if CHART_MODE == "client" else ""
 
     def build_page(is_m):
         return f"""<!DOCTYPE html><html lang="zh-TW"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><link rel="icon" href="https://cdn-icons-png.flaticon.com/512/2422/2422796.png"><title>AI 美股深度掃描</title>
@@ -209,6 +1041,7 @@ def create_html_report(df):
             .card-header-row {{ background: #003366; color: white; padding: 12px; display: grid; grid-template-columns: 80px 200px 100px 80px 80px 80px 1fr; text-align: center; font-size: 13px; font-weight: bold; align-items: center; }}
             @media (max-width: 768px) {{ .card-header-row {{ grid-template-columns: repeat(2, 1fr); font-size: 11px; gap: 8px; }} }}
             .chart-stack {{ display: flex; flex-direction: column; gap: 20px; align-items: center; background: #1a1a1a; padding: 15px; }} .chart-stack img {{ width: 100%; height: auto; border: 1px solid #444; }}
+            .chart-box {{ width: 100%; border: 1px solid #444; }}
             .toggle-bar {{ background: #333; padding: 10px; width: 100%; display: flex; justify-content: center; gap: 5px; flex-wrap: wrap; border-bottom: 1px solid #444; }}
             .toggle-btn {{ background: #555; color: white; border: none; padding: 6px 12px; border-radius: 4px; cursor: pointer; font-size: 11px; }} .toggle-btn.active {{ background: #2563eb; font-weight: bold; }}
             .analysis-box {{ padding: 25px; line-height: 1.8; background: #f8fafc; font-size: 14px; border-top: 1px solid #eee; }}
@@ -219,19 +1052,27 @@ def create_html_report(df):
             function switchPeriod(ticker, period) {{
                 const pArr = ['1m', '3m', '6m', '1y', 'max'];
                 pArr.forEach(p => {{
-                    document.getElementById('img-' + p + '-' + ticker).style.display = (p === period) ? 'block' : 'none';
+                    const img = document.getElementById('img-' + p + '-' + ticker);
+                    if (img) img.style.display = (p === period) ? 'block' : 'none';
                     document.getElementById('btn-' + p + '-' + ticker).classList.toggle('active', p === period);
                 }});
+                if (document.getElementById('chart-' + ticker)) drawPeriod(ticker, period);
             }}
             async function shareTicker(t, p) {{
                 const s = {{ title: `📈 AI 掃描: ${{t}}`, text: `代碼 ${{t}} 目前 $${{p}}。點擊查看分析。`, url: window.location.origin + window.location.pathname + '?ticker=' + t }};
                 try {{ if (navigator.share) {{ await navigator.share(s); }} else {{ alert('網址已複製'); navigator.clipboard.writeText(s.url); }} }} catch (e) {{}}
             }}
+            document.addEventListener('DOMContentLoaded', () => {{
+                const bar = document.querySelector('.history-bar'), base = bar.dataset.base;
+                fetch(base + 'manifest.json').then(r => r.json()).then(m => {{
+                    bar.insertAdjacentHTML('beforeend', m.reports.map(r => `<a href="${{base}}${{r.file}}" class="history-item">${{r.date}}</a>`).join(''));
+                }}).catch(() => {{}});
+            }});
             window.onload = function() {{
                 const p = new URLSearchParams(window.location.search); const t = p.get('ticker');
                 if (t) {{ const e = document.getElementById(t.toUpperCase()); if (e) {{ setTimeout(() => {{ e.scrollIntoView({{ behavior: 'smooth', block: 'start' }}); }}, 600); }} }}
             }};
-        </script></head><body><div class="container" id="top">{get_nav(is_m)}
+        </script>{client_js}</head><body><div class="container" id="top">{get_nav(is_m)}
         <h1 style="color:#003366; text-align:center; margin-bottom: 5px;">📊 美股 AI 全量深度報告 {VERSION}</h1>
         <h3 style="color:#666; text-align:center; margin-top: 0; font-weight: normal;">🇺🇸 美股交易日：{today_ny}</h3>
         <div class="summary-table-wrapper"><table class="summary-table"><thead><tr><th>代碼</th><th>公司</th><th>產業</th><th>市值</th><th>P/E</th><th>價格</th><th>漲幅</th><th>成交量</th></tr></thead><tbody>"""
@@ -242,12 +1083,23 @@ def create_html_report(df):
             h += f"<tr onclick=\"window.location='#{row['Ticker']}';\"><td><b>{row['Ticker']}</b></td><td>{row['Company']}</td><td>{row['Industry']}</td><td>{row['MarketCap']}</td><td>{row['PE']}</td><td>${row['Price']}</td><td style='color:red;'>+{row['Change']}%</td><td>{row['Volume']}</td></tr>"
         return h
 
-    cards = ""
-    for _, row in df.iterrows():
-        m1, m3, m6, y1, mmax, m_intra, is_a = generate_stock_images(row['Ticker'])
-        ins = all_insights.get(row['Ticker'], "⚠️ 分析產出中...")
-        if y1:
-            cards += f"""<div class="stock-card" id="{row['Ticker']}"><div class="card-header-row"><div>{row['Ticker']}</div><div>{row['Industry']}</div><div>{row['MarketCap']}</div><div>{row['PE']}</div><div>${row['Price']}</div><div style="color:#ffcccc;">+{row['Change']}%</div><div>{row['Volume']}</div></div>
+    def get_chart_stack(t, media, a):
+        # a 為資產目錄相對路徑 (首頁 ./assets/、歷史頁 ../assets/)；隱藏中的區間圖在切換前不會被下載
+        if CHART_MODE == "client":
+            return f"""<div class="chart-stack"><div id="chart-{t}" class="chart-box" data-src="{a}{media}"></div><div id="intra-{t}" class="chart-box"></div></div>"""
+        m1, m3, m6, y1, mmax, m_intra = media
+        intra = f'<img src="{a}{m_intra}" loading="lazy" width="1050" height="450">' if m_intra else ""
+        return f"""<div class="chart-stack">
+                <img id="img-1m-{t}" src="{a}{m1}" loading="lazy" width="1050" height="800" style="display:none;">
+                <img id="img-3m-{t}" src="{a}{m3}" loading="lazy" width="1050" height="800" style="display:none;">
+                <img id="img-6m-{t}" src="{a}{m6}" loading="lazy" width="1050" height="800" style="display:none;">
+                <img id="img-1y-{t}" src="{a}{y1}" loading="lazy" width="1050" height="800">
+                <img id="img-max-{t}" src="{a}{mmax}" loading="lazy" width="1050" height="800" style="display:none;">
+                {intra}
+            </div>"""
+
+    def get_card(row, media, ins, a):
+        return f"""<div class="stock-card" id="{row['Ticker']}"><div class="card-header-row"><div>{row['Ticker']}</div><div>{row['Industry']}</div><div>{row['MarketCap']}</div><div>{row['PE']}</div><div>${row['Price']}</div><div style="color:#ffcccc;">+{row['Change']}%</div><div>{row['Volume']}</div></div>
             <div class="toggle-bar">
                 <button id="btn-1m-{row['Ticker']}" class="toggle-btn" onclick="switchPeriod('{row['Ticker']}', '1m')">1M</button>
                 <button id="btn-3m-{row['Ticker']}" class="toggle-btn" onclick="switchPeriod('{row['Ticker']}', '3m')">3M</button>
@@ -255,23 +1107,142 @@ def create_html_report(df):
                 <button id="btn-1y-{row['Ticker']}" class="toggle-btn active" onclick="switchPeriod('{row['Ticker']}', '1y')">1Y</button>
                 <button id="btn-max-{row['Ticker']}" class="toggle-btn" onclick="switchPeriod('{row['Ticker']}', 'max')">MAX</button>
             </div>
-            <div class="chart-stack">
-                <img id="img-1m-{row['Ticker']}" src="data:image/png;base64,{m1}" style="display:none;">
-                <img id="img-3m-{row['Ticker']}" src="data:image/png;base64,{m3}" style="display:none;">
-                <img id="img-6m-{row['Ticker']}" src="data:image/png;base64,{m6}" style="display:none;">
-                <img id="img-1y-{row['Ticker']}" src="data:image/png;base64,{y1}">
-                <img id="img-max-{row['Ticker']}" src="data:image/png;base64,{mmax}" style="display:none;">
-                <img src="data:image/png;base64,{m_intra}">
-            </div>
+            {get_chart_stack(row['Ticker'], media, a)}
             <div class="analysis-box"><strong>🛡️ AI 策略師深度診斷：</strong><br>{ins}<div class="btn-group"><button class="action-btn share-btn" onclick="shareTicker('{row['Ticker']}', '{row['Price']}')">📲 分享此股票</button><a href="#top" class="action-btn">⬆ 返回總表</a></div></div></div>"""
-    
-    rows_h = get_rows(df)
-    with open("index.html", "w", encoding="utf-8") as f: 
-        f.write(build_page(True) + rows_h + "</tbody></table></div>" + cards + "</div></body></html>")
-    with open(f"history/report_{today_str}.html", "w", encoding="utf-8") as f: 
-        f.write(build_page(False) + rows_h + "</tbody></table></div>" + cards + "</div></body></html>")
+
+    print(f">>> [步驟 2] 串流產生報告 (共 {len(df)} 支符合門檻之股票；AI 分析與圖表{'資料' if CHART_MODE == 'client' else '渲染'}同步進行)...")
+    rows_h, rows_by_t = get_rows(df), {r['Ticker']: r for r in df.to_dict('records')}
+    # 首頁與歷史頁只有導覽列與資產相對路徑不同：同一串卡片同時寫入兩個暫存檔，完成後才原子替換
+    paths, prefixes = ["index.html", f"history/report_{today_str}.html"], [f"./{ASSET_DIR}/", f"../{ASSET_DIR}/"]
+    outs = [open(p + ".tmp", "w", encoding="utf-8") for p in paths]
+    try:
+        with PROFILER.stage("write_page"):
+            for f, is_m in zip(outs, (True, False)): f.write(build_page(is_m) + rows_h + "</tbody></table></div>")
+        for t, media, is_a, ins in run_pipeline(df, journal, retry_failed):
+            if not media: continue
+            with PROFILER.stage("write_card", t):
+                for f, a in zip(outs, prefixes): f.write(get_card(rows_by_t[t], media, ins, a))
+        # 頁尾的剖析是寫檔當下的快照；含原子替換與存檔清單的完整版本另存 data/profiles/<日期>.json
+        footer = profile_footer(PROFILER.summary(day=journal.day, mode=CHART_MODE, total=len(df)))
+        with PROFILER.stage("write_page"):
+            for f in outs: f.write(footer + "</div></body></html>")
+    finally:
+        for f in outs: f.close()
+    with PROFILER.stage("write_page"):
+        for p in paths: os.replace(p + ".tmp", p)
+        update_history_manifest(f"report_{today_str}.html")
+    prof = PROFILER.save(os.path.join(PROFILE_DIR, f"{journal.day}.json"), day=journal.day, mode=CHART_MODE, total=len(df))
+    top = sorted(prof["stages"].items(), key=lambda kv: -kv[1]["wall"])[:4]
+    print(f"   ↳ 剖析：總耗時 {prof['elapsed']:.1f}s、行程 RSS 高峰 {prof['peak_rss_mb']} MB；" + "、".join(f"{k} {v['wall']:.1f}s" for k, v in top))
+    failed = [t for t in df['Ticker'] if journal.failed(t)]
+    ai_failed = [t for t in df['Ticker'] if journal.failed(t, ("insight",))]
+    if failed: print(f"⚠️ {len(failed)} 支圖表階段失敗 ({', '.join(failed[:10])}{'…' if len(failed) > 10 else ''})")
+    if ai_failed: print(f"⚠️ {len(ai_failed)} 支 AI 分析失敗 ({', '.join(ai_failed[:10])}{'…' if len(ai_failed) > 10 else ''})")
+    if failed or ai_failed: print("   ↳ 可執行 python app_cron.py --retry-failed 只重跑失敗的部分 (AI 分析失敗者只重新詢問 Gemini，不重抓、不重繪)")
+
+# ==========================================
+# 6. 歷史回測 (以本地日線重播篩選條件、平行掃描門檻參數)
+# ==========================================
+SCREEN_DEFAULTS = dict(min_price=1.0, min_volume=500000, min_relvol=5.0, min_change=0.0,
+                       max_change=MAX_CHANGE_PCT, min_cap=MIN_MKT_CAP, above_sma200=None)
+BACKTEST_GRID = dict(max_change=[10, 15, 20, 30, 40], min_relvol=[2.0, 3.0, 5.0, 8.0], min_price=[1.0, 5.0], above_sma200=[None, True])
+BACKTEST_HORIZONS = (1, 5, 20)
+_BT = {}
+
+def load_ohlcv_panel(tickers, root=None):
+    """把多檔日線依日期聯集對齊成 (日期, 標的) 面板；缺資料處為 NaN"""
+    frames = {t: load_ohlcv(t, root) for t in tickers}
+    frames = {t: d for t, d in frames.items() if not d.empty}
+    days = {t: d.index.values.astype('datetime64[D]') for t, d in frames.items()}
+    dates = np.unique(np.concatenate(list(days.values()))) if days else np.array([], dtype='datetime64[D]')
+    panel = {f: np.full((len(dates), len(frames)), np.nan) for f in OHLCV_FIELDS}
+    for j, (t, d) in enumerate(frames.items()):
+        pos = np.searchsorted(dates, days[t])
+        for f in OHLCV_FIELDS: panel[f][pos, j] = d[f].to_numpy()
+    return dates, list(frames), panel
+
+def prepare_backtest(panel, shares=None, tickers=None, horizons=BACKTEST_HORIZONS):
+    """預先算好所有條件共用的面板：漲幅 %、相對成交量 (對前 63 日均量)、SMA200、市值與各持有天數的前瞻報酬"""
+    close, volume = panel['Close'], panel['Volume']
+    prev = np.vstack([np.full((1, close.shape[1]), np.nan), close[:-1]])
+    avg_vol = np.vstack([np.full((1, close.shape[1]), np.nan), _rolling_mean(volume, 63)[:-1]])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        change = (close / prev - 1) * 100
+        relvol = volume / avg_vol
+        fwd = {h: np.vstack([close[h:] / close[:-h] - 1, np.full((h, close.shape[1]), np.nan)]) for h in horizons}
+    cap = None
+    if shares and tickers:
+        cap = close * np.array([shares.get(t, np.nan) for t in tickers], dtype='float64')
+    return dict(close=close, volume=volume, change=change, relvol=relvol, above=close > _rolling_mean(close, 200), cap=cap, fwd=fwd)
+
+def _bt_init(prepared):
+    _BT.update(prepared)
+
+def evaluate_screen(params, prepared=None):
+    """以向量運算在整個 (日期, 標的) 面板上套用一組門檻，回傳訊號數與各持有天數的平均 / 中位數報酬與勝率"""
+    b, p = prepared or _BT, dict(SCREEN_DEFAULTS, **params)
+    with np.errstate(invalid='ignore'):
+        m = (b['close'] > p['min_price']) & (b['volume'] > p['min_volume']) & (b['relvol'] > p['min_relvol']) \
+            & (b['change'] > p['min_change']) & (b['change'] <= p['max_change'])
+        if b['cap'] is not None: m &= b['cap'] >= p['min_cap']
+    if p['above_sma200'] is not None: m &= b['above'] == p['above_sma200']
+    row = dict(params, signals=int(m.sum()), days=int(m.any(axis=1).sum()))
+    for h, fwd in b['fwd'].items():
+        x = fwd[m]; x = x[~np.isnan(x)]
+        row[f"mean_{h}d"] = float(x.mean()) * 100 if len(x) else np.nan
+        row[f"median_{h}d"] = float(np.median(x)) * 100 if len(x) else np.nan
+        row[f"win_{h}d"] = float((x > 0).mean()) * 100 if len(x) else np.nan
+    return row
+
+def load_universe(path):
+    """讀取回測標的清單檔：每行一個代碼 (可用逗號或空白分隔)，# 之後為註解"""
+    with open(path, encoding="utf-8") as f:
+        return list(dict.fromkeys(t.upper() for line in f for t in re.split(r"[\s,]+", line.split("#", 1)[0]) if t))
+
+def run_backtest(tickers=None, grid=None, shares=None, workers=None, root=None, from_store=False):
+    """對指定的標的範圍重播篩選條件並平行掃描 grid 的所有組合，依 5 日平均報酬排序回傳 DataFrame。
+    本地行情庫只存放過去通過篩選的標的，直接拿來調參會有選樣偏誤；必須明確給 tickers，或以 from_store=True 自行承擔"""
+    if tickers: update_ohlcv_store(tickers, root=root)
+    elif from_store:
+        tickers = sorted(os.path.basename(p)[:-4] for p in glob.glob(os.path.join(root or OHLCV_DIR, "*.npy")) if not p.endswith(".tmp.npy"))
+        print("⚠️" * 3 + " [回測] 使用本地行情庫作為標的範圍：這些標的都是過去通過篩選才被收錄的，結果有選樣偏誤、前瞻報酬會被高估；"
+              "請改用 --universe <代碼清單檔> 指定完整的標的範圍 (如指數成分股)")
+    else: raise ValueError("回測需要明確的標的範圍 (tickers)，或指定 from_store=True 使用本地行情庫")
+    dates, tickers, panel = load_ohlcv_panel(tickers, root)
+    if not tickers: print("❌ 本地行情庫沒有資料可回測"); return pd.DataFrame()
+    grid = grid or BACKTEST_GRID
+    combos = [dict(zip(grid, vals)) for vals in itertools.product(*grid.values())]
+    print(f">>> [回測] {len(tickers)} 支標的 × {len(dates)} 個交易日 ({dates[0]} ~ {dates[-1]})，共 {len(combos)} 組參數")
+    if not shares: print("   ↳ 未提供流通股數，市值門檻不套用 (其餘條件：價格、成交量、相對量、漲幅、SMA200)")
+    prepared = prepare_backtest(panel, shares, tickers)
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1: rows = [evaluate_screen(c, prepared) for c in combos]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_bt_init, initargs=(prepared,)) as ex:
+            rows = list(ex.map(evaluate_screen, combos, chunksize=max(1, len(combos) // (workers * 4))))
+    res = pd.DataFrame(rows).sort_values(f"mean_{BACKTEST_HORIZONS[1]}d", ascending=False, na_position='last').reset_index(drop=True)
+    os.makedirs("data", exist_ok=True); res.to_csv(os.path.join("data", "backtest.csv"), index=False)
+    return res
 
 if __name__ == "__main__":
-    if is_market_open_today():
-        df_res = fetch_and_filter_stocks()
-        if not df_res.empty: create_html_report(df_res)
+    if "--backtest" in sys.argv:
+        # python app_cron.py --backtest (--universe <清單檔> | TICKER ... | --from-store)
+        args = sys.argv[1:]
+        tickers = load_universe(args[args.index("--universe") + 1]) if "--universe" in args[:-1] else []
+        tickers += [a.upper() for i, a in enumerate(args) if not a.startswith("--") and (i == 0 or args[i - 1] != "--universe")]
+        if not tickers and "--from-store" not in args:
+            print("❌ 請指定回測標的範圍：--universe <代碼清單檔>、直接列出代碼，或 --from-store (本地行情庫，有選樣偏誤)"); sys.exit(1)
+        res = run_backtest(tickers or None, from_store="--from-store" in args)
+        if not res.empty: print(res.head(20).to_string(float_format=lambda v: f"{v:.2f}"))
+    else:
+        # 同一交易日重跑時從 data/runs/<日期>.json 續跑；--retry-failed 重跑圖表階段失敗的標的並重問 AI 分析失敗者
+        retry = "--retry-failed" in sys.argv
+        if retry or is_market_open_today():
+            journal = RunJournal.load(_today_ny().isoformat())
+            df_res = journal.screen()
+            if df_res is not None: print(f">>> [續跑] 沿用 {journal.day} 的篩選結果 ({len(df_res)} 支)")
+            elif retry: print(f"❌ {journal.day} 尚無執行紀錄可重試"); sys.exit(1)
+            else:
+                df_res = fetch_and_filter_stocks()
+                if not df_res.empty: journal.set_screen(df_res)
+            if not df_res.empty: create_html_report(df_res, journal, retry)
@@ -0,0 +1,207 @@
+"""app_cron 離線基準測試：合成日線 / 盤中行情、本機 HTTP 伺服器提供的 Finviz 篩選頁與假 Gemini，跑完整條管線量測吞吐量與記憶體。
+
+    python bench_cron.py                                  # 10 / 100 / 1000 支，client 繪圖模式
+    python bench_cron.py --sizes 10 100 --chart-mode png  # png 模式 (需要 kaleido)
+    python bench_cron.py --screener-dir pages/            # 改用自行錄製的 Finviz HTML (依檔名排序為第 1、2… 頁)
+    python bench_cron.py --save-baseline bench_baseline.json
+    python bench_cron.py --baseline bench_baseline.json   # 吞吐量下降或記憶體增加超過 --tolerance 時以 1 結束
+
+repo 不附錄製的篩選頁 (Finviz 內容不便再散布)；預設使用依 v=111 版面合成的頁面，與真實頁面走同一套 lxml / BeautifulSoup 解析與分頁邏輯。
+每個規模在獨立子行程與暫存目錄中執行 (記憶體高峰互不影響、不碰工作目錄的 data/ 與報告)，子行程輸出附加到 data/bench_output.txt (已在 .gitignore)。
+"""
+import os, sys, json, time, types, shutil, tempfile, zlib, argparse, subprocess, threading, datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIZES = (10, 100, 1000)
+PAGE_ROWS = 20  # Finviz 每頁筆數
+RESULT_TAG = "BENCH_RESULT "
+LOG_FILE = os.path.join(HERE, "data", "bench_output.txt")
+
+# ==========================================
+# 1. 合成資料 (依代碼決定亂數種子，同一代碼每次結果相同)
+# ==========================================
+def _rng(ticker, salt=""):
+    import numpy as np
+    return np.random.default_rng(zlib.crc32((ticker + salt).encode("utf-8")))
+
+def synthetic_tickers(n):
+    # 純字母代碼 (Finviz 風格)：AAAA, AAAB, ...
+    out = []
+    for i in range(n):
+        s, k = "", i
+        for _ in range(4): s, k = chr(65 + k % 26) + s, k // 26
+        out.append(s)
+    return out
+
+def screener_pages(tickers):
+    """產生與 Finviz v=111 版面相同欄位的篩選頁 HTML (每頁 PAGE_ROWS 列，含「#1 / N Total」總筆數)"""
+    pages = []
+    for p in range(0, max(len(tickers), 1), PAGE_ROWS):
+        rows = []
+        for i, t in enumerate(tickers[p:p + PAGE_ROWS], p + 1):
+            r = _rng(t, "screen")
+            cells = [str(i), t, f"{t} Holdings Inc", "Technology", ["Software", "Semiconductors", "Biotechnology", "Banks"][i % 4], "USA",
+                     f"{r.uniform(0.2, 80):.2f}B", f"{r.uniform(5, 60):.2f}", f"{r.uniform(5, 300):.2f}", f"{r.uniform(0.5, 19):.2f}%", f"{int(r.integers(500_000, 30_000_000)):,}"]
+            rows.append('<tr valign="top">' + "".join(f'<td><a href="quote.ashx?t={t}">{c}</a></td>' for c in cells) + "</tr>")
+        pages.append(f'<html><body><div id="screener-total">#{p + 1} / {len(tickers)} Total</div><table>{"".join(rows)}</table></body></html>')
+    return pages
+
+def _frame(index, close, rng, volume):
+    import pandas as pd
+    import numpy as np
+    spread = np.abs(rng.normal(0, 0.01, len(close))) * close
+    open_ = close * (1 + rng.normal(0, 0.005, len(close)))
+    return pd.DataFrame({"Open": open_, "High": np.maximum(open_, close) + spread, "Low": np.minimum(open_, close) - spread,
+                         "Close": close, "Volume": rng.integers(volume // 4, volume * 2, len(close)).astype("float64")}, index=index)
+
+def fake_download(tickers, period=None, start=None, interval="1d", **kwargs):
+    """與 yf.download 介面相同的離線替身：日線回傳 (ticker, 欄位) 雙層欄位，1m 回傳當日 04:00–20:00 (美東) 的盤中 K 棒"""
+    import pandas as pd
+    import numpy as np
+    single = isinstance(tickers, str)
+    names = [tickers] if single else list(tickers)
+    today = pd.Timestamp(datetime.datetime.now(datetime.timezone.utc).astimezone(datetime.timezone(datetime.timedelta(hours=-5))).date())
+    frames = {}
+    for t in names:
+        r = _rng(t)
+        if interval == "1m":
+            idx = pd.date_range(today + pd.Timedelta(hours=4), today + pd.Timedelta(hours=20), freq="1min", inclusive="left", tz="America/New_York").tz_convert("UTC")
+            close = 50 * np.exp(np.cumsum(r.normal(0, 0.002, len(idx))))
+            frames[t] = _frame(idx, close, r, 20_000)
+            continue
+        full = pd.bdate_range(end=today, periods=int(period[:-1]) * 252 if period else 1100)
+        close = 20 * np.exp(np.cumsum(r.normal(0.0004, 0.02, len(full))))
+        df = _frame(full, close, r, 2_000_000)
+        frames[t] = df[df.index >= pd.Timestamp(start)] if start else df
+    if single: return frames[tickers]
+    return pd.concat(frames, axis=1)
+
+class _ScreenerHandler(BaseHTTPRequestHandler):
+    pages = []
+
+    def do_GET(self):
+        r = int(parse_qs(urlparse(self.path).query).get("r", ["1"])[0])
+        i = (r - 1) // PAGE_ROWS
+        body = (self.pages[i] if i < len(self.pages) else "<html></html>").encode("utf-8")
+        self.send_response(200); self.send_header("Content-Type", "text/html; charset=utf-8"); self.send_header("Content-Length", str(len(body))); self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): pass
+
+def serve_screener(pages):
+    _ScreenerHandler.pages = pages
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ScreenerHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/screener.ashx?v=111"
+
+# ==========================================
+# 2. 單一規模 (子行程內執行)
+# ==========================================
+def run_one(n, chart_mode, screener_dir=None, workers=None, ai_delay=0.05):
+    work = tempfile.mkdtemp(prefix="bench_cron_")
+    os.chdir(work); sys.path.insert(0, HERE)
+    try:
+        import app_cron as A
+        A.CHART_MODE = chart_mode
+        if workers: A.RENDER_WORKERS = workers
+        A.yf.download = fake_download
+        A.GEMINI_KEY, A.GEMINI_RPM = "bench", 6000
+        A.genai = types.SimpleNamespace(Client=lambda api_key: A.FakeGeminiClient(delay=ai_delay))
+        if screener_dir:
+            files = sorted(os.listdir(screener_dir))
+            pages = [open(os.path.join(screener_dir, f), encoding="utf-8").read() for f in files if f.endswith((".html", ".htm"))]
+        else: pages = screener_pages(synthetic_tickers(n))
+        server, url = serve_screener(pages)
+        A.PROFILER.reset()
+        t0 = time.perf_counter()
+        df = A.fetch_and_filter_stocks(base_url=url).head(n)
+        if df.empty: raise SystemExit("篩選結果為空，請檢查篩選頁內容")
+        journal = A.RunJournal.load(A._today_ny().isoformat())
+        journal.set_screen(df)
+        A.create_html_report(df, journal)
+        elapsed = time.perf_counter() - t0
+        server.shutdown(); A.shutdown_render_pool()
+        prof = A.PROFILER.summary()
+        # 渲染 worker 由 forkserver 產生、不是本行程的直接子行程，RUSAGE_CHILDREN 量不到；改用 worker 回報的 RSS 高峰
+        workers_rss = prof["stages"].get("to_image", {}).get("peak_so_far")
+        size_mb = lambda d: round(sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(d) for f in fs) / 2**20, 2) if os.path.isdir(d) else 0.0
+        return {"n": n, "mode": chart_mode, "tickers": len(df), "elapsed": round(elapsed, 3), "throughput": round(len(df) / elapsed, 3),
+                "peak_rss_mb": A._peak_rss_mb(), "worker_rss_mb": workers_rss, "report_kb": round(os.path.getsize("index.html") / 1024, 1),
+                "assets_mb": size_mb(A.ASSET_DIR), "stages": {k: v["wall"] for k, v in prof["stages"].items()},
+                "errors": {k: v["errors"] for k, v in prof["stages"].items() if v["errors"]}}
+    finally:
+        os.chdir(HERE); shutil.rmtree(work, ignore_errors=True)
+
+# ==========================================
+# 3. 彙總與基準比較
+# ==========================================
+def compare(results, baseline, tolerance):
+    """回傳退化清單：吞吐量低於基準 (1 - tolerance) 倍，或記憶體高峰高於基準 (1 + tolerance) 倍"""
+    base = {(b["n"], b["mode"]): b for b in baseline["results"]}
+    bad = []
+    for r in results:
+        b = base.get((r["n"], r["mode"]))
+        if b is None: continue
+        if r["throughput"] < b["throughput"] * (1 - tolerance): bad.append(f"{r['mode']} n={r['n']} 吞吐量 {b['throughput']:.2f} → {r['throughput']:.2f} 支/秒")
+        if r["peak_rss_mb"] and b.get("peak_rss_mb") and r["peak_rss_mb"] > b["peak_rss_mb"] * (1 + tolerance):
+            bad.append(f"{r['mode']} n={r['n']} 記憶體高峰 {b['peak_rss_mb']:.0f} → {r['peak_rss_mb']:.0f} MB")
+    return bad
+
+def print_table(results, baseline=None):
+    base = {(b["n"], b["mode"]): b for b in (baseline or {}).get("results", [])}
+    print(f"{'模式':<7}{'標的':>6}{'耗時(s)':>10}{'支/秒':>9}{'RSS(MB)':>9}{'worker(MB)':>11}{'報告(KB)':>10}{'資產(MB)':>9}  {'基準差異':<16} 最耗時階段")
+    for r in results:
+        b = base.get((r["n"], r["mode"]))
+        delta = f"{(r['throughput'] / b['throughput'] - 1) * 100:+.0f}% 支/秒" if b else ""
+        top = ", ".join(f"{k} {v:.1f}s" for k, v in sorted(r["stages"].items(), key=lambda kv: -kv[1])[:3])
+        print(f"{r['mode']:<7}{r['tickers']:>6}{r['elapsed']:>10.2f}{r['throughput']:>9.2f}{r['peak_rss_mb'] or 0:>9.0f}{r.get('worker_rss_mb') or 0:>11.0f}{r['report_kb']:>10.0f}{r['assets_mb']:>9.1f}  {delta:<16} {top}")
+        if r["errors"]: print(f"       ⚠️ 階段失敗：{r['errors']}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="app_cron 離線基準測試")
+    ap.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    ap.add_argument("--chart-mode", choices=["client", "png"], default="client")
+    ap.add_argument("--workers", type=int, default=None, help="png 模式的渲染行程數 (預設同 RENDER_WORKERS)")
+    ap.add_argument("--screener-dir", default=None, help="錄製的 Finviz 篩選頁目錄 (依檔名排序)")
+    ap.add_argument("--ai-delay", type=float, default=0.05, help="假 Gemini 每次請求的延遲秒數")
+    ap.add_argument("--baseline", default=None, help="與此基準 JSON 比較，退化時以 1 結束")
+    ap.add_argument("--tolerance", type=float, default=0.2)
+    ap.add_argument("--save-baseline", default=None)
+    ap.add_argument("--run-one", type=int, default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+
+    if args.run_one is not None:
+        res = run_one(args.run_one, args.chart_mode, args.screener_dir and os.path.abspath(args.screener_dir), args.workers, args.ai_delay)
+        print(RESULT_TAG + json.dumps(res, ensure_ascii=False)); return 0
+
+    results = []
+    for n in args.sizes:
+        cmd = [sys.executable, os.path.abspath(__file__), "--run-one", str(n), "--chart-mode", args.chart_mode, "--ai-delay", str(args.ai_delay)]
+        if args.workers: cmd += ["--workers", str(args.workers)]
+        if args.screener_dir: cmd += ["--screener-dir", os.path.abspath(args.screener_dir)]
+        print(f">>> [基準測試] {args.chart_mode} 模式 {n} 支…", flush=True)
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+        with open(LOG_FILE, "a", encoding="utf-8") as f: f.write(f"===== {' '.join(cmd[2:])}\n{proc.stdout}{proc.stderr}")
+        line = next((l for l in proc.stdout.splitlines() if l.startswith(RESULT_TAG)), None)
+        if proc.returncode or line is None: print(f"❌ {n} 支執行失敗 (詳見 {LOG_FILE})：{proc.stderr.strip().splitlines()[-1:] }"); return 2
+        results.append(json.loads(line[len(RESULT_TAG):]))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f: baseline = json.load(f)
+    print_table(results, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f: json.dump({"python": sys.version.split()[0], "results": results}, f, ensure_ascii=False, indent=1)
+        print(f"   ↳ 已寫入基準 {args.save_baseline}")
+    if baseline:
+        bad = compare(results, baseline, args.tolerance)
+        for b in bad: print(f"❌ 效能退化：{b}")
+        if bad: return 1
+        print(f"✅ 與基準相比無超過 {args.tolerance:.0%} 的退化")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,33 @@
+# 測試共用的離線替身：合成日線與 yf.download 介面相同的假下載器
+import os, sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_ohlcv(n, seed, end="2026-10-16"):
+    rng = np.random.default_rng(seed)
+    idx = pd.bdate_range(end=end, periods=n)
+    close = 20 * np.exp(np.cumsum(rng.normal(0, 0.02, n)))
+    return pd.DataFrame({"Open": close * (1 + rng.normal(0, 0.005, n)), "High": close * 1.01, "Low": close * 0.99,
+                         "Close": close, "Volume": rng.integers(1e5, 1e6, n).astype(float)}, index=idx)
+
+
+class FakeDownloader:
+    """frames 為資料源「目前」的 {ticker: 日線}；依 period / start 切片回傳雙層欄位，盤中 (1m) 一律回傳空表。
+    fail 內的代碼當作下載不到資料，calls 記錄每次呼叫的 (代碼, 區間)"""
+    def __init__(self, frames, fail=()):
+        self.frames, self.fail, self.calls = frames, set(fail), []
+
+    def __call__(self, tickers, period=None, start=None, interval="1d", **kwargs):
+        if interval == "1m": return pd.DataFrame()
+        names = [tickers] if isinstance(tickers, str) else list(tickers)
+        self.calls.append((tuple(names), dict(period=period) if period else dict(start=start)))
+        out = {}
+        for t in names:
+            if t in self.fail or t not in self.frames: continue
+            df = self.frames[t]
+            out[t] = df[df.index >= pd.Timestamp(start)] if start else df
+        return pd.concat(out, axis=1) if out else pd.DataFrame()
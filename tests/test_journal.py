@@ -0,0 +1,125 @@
+# 執行紀錄的續跑 / 重試規則：資料失敗後 --retry-failed、只有 AI 分析失敗、已完成標的的資產檔遺失或繪圖模式切換
+import glob
+import os
+import types
+
+import pandas as pd
+import pytest
+
+import app_cron as A
+from conftest import FakeDownloader, make_ohlcv
+
+TICKERS = ["AAA", "BBB", "CCC", "DDD"]
+
+
+class PartialGemini(A.FakeGeminiClient):
+    """回應中漏掉 drop 內的代碼 (拆批重送後仍缺)，讓這些標的最後落到 AI_FALLBACK"""
+    def __init__(self, drop):
+        super().__init__(); self.drop = set(drop)
+
+    async def generate_content(self, model, contents):
+        for t in self.drop: contents = contents.replace(f"- {t}:", "- ???:")
+        return await super().generate_content(model, contents)
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(A, "CHART_MODE", "client")
+    src = FakeDownloader({t: make_ohlcv(300, i, end=A._today_ny()) for i, t in enumerate(TICKERS)})
+    monkeypatch.setattr(A.yf, "download", src)
+    gemini = types.SimpleNamespace(client=A.FakeGeminiClient())
+    monkeypatch.setattr(A, "GEMINI_KEY", "test")
+    monkeypatch.setattr(A, "genai", types.SimpleNamespace(Client=lambda api_key: gemini.client))
+    monkeypatch.setattr(A, "GEMINI_RPM", 6000)
+    processed, fetch_intraday = [], A.fetch_intraday  # 每支實際走過資料 / 繪圖階段的標的都會抓一次盤中
+    monkeypatch.setattr(A, "fetch_intraday", lambda t: processed.append(t) or fetch_intraday(t))
+    df = pd.DataFrame({"Ticker": TICKERS, "Company": TICKERS, "Industry": "Software", "MarketCap": "1.2B",
+                       "PE": "20", "Price": 10.0, "Change": 5.0, "Volume": "1,000,000"})
+    return types.SimpleNamespace(src=src, gemini=gemini, processed=processed, df=df, day=A._today_ny().isoformat())
+
+
+def run(env, retry_failed=False):
+    # 每次都從磁碟重新載入紀錄，等同重新執行一次 app_cron.py
+    journal = A.RunJournal.load(env.day)
+    out = {t: (media, ins) for t, media, _, ins in A.run_pipeline(env.df, journal, retry_failed)}
+    return out, A.RunJournal.load(env.day)
+
+
+def downloaded(env, since):
+    return sorted({t for names, _ in env.src.calls[since:] for t in names})
+
+
+def rebuilt(env, since):
+    return sorted(env.processed[since:])
+
+
+def test_data_failure_then_retry_failed(env):
+    env.src.fail = {"BBB"}
+    out, j = run(env)
+    assert out["BBB"][0] is None and j.failed("BBB") and j.finished("BBB")
+    assert all(out[t][0] for t in TICKERS if t != "BBB")
+    # 一般重跑不會再碰失敗的標的
+    n = len(env.src.calls)
+    out, j = run(env)
+    assert downloaded(env, n) == [] and out["BBB"][0] is None
+    # --retry-failed：只重抓 BBB，其餘沿用既有圖表
+    env.src.fail = set(); n, m = len(env.src.calls), len(env.processed)
+    out, j = run(env, retry_failed=True)
+    assert downloaded(env, n) == ["BBB"] and rebuilt(env, m) == ["BBB"]
+    assert all(out[t][0] for t in TICKERS) and not any(j.failed(t) for t in TICKERS)
+
+
+def test_insight_only_failure_reasks_gemini_without_rerendering(env):
+    env.gemini.client = PartialGemini(drop={"CCC"})
+    out, j = run(env)
+    assert out["CCC"][1] == A.AI_FALLBACK and j.failed("CCC", ("insight",))
+    assert not j.failed("CCC") and j.finished("CCC")  # 圖表階段不受影響
+    images = {t: j.get(t, "images") for t in TICKERS}
+    env.gemini.client = A.FakeGeminiClient(); n, m = len(env.src.calls), len(env.processed)
+    out, j = run(env, retry_failed=True)
+    assert downloaded(env, n) == [] and rebuilt(env, m) == []
+    assert {t: j.get(t, "images") for t in TICKERS} == images  # 沒有重新繪圖
+    assert env.gemini.client.calls >= 1 and out["CCC"][1] == env.gemini.client.text
+    assert not j.failed("CCC", ("insight",))
+
+
+def test_insight_failure_before_images_does_not_drop_the_card(env):
+    # 中斷情境：AI 分析先記錄失敗，圖表階段還沒寫入就被終止
+    j = A.RunJournal.load(env.day); j.set_screen(env.df)
+    for t in TICKERS: j.record(t, "insight", False, A.AI_FALLBACK, text=A.AI_FALLBACK)
+    j.flush()
+    out, j = run(env)
+    assert all(out[t][0] for t in TICKERS)
+
+
+def test_no_api_key_is_not_a_failure(env, monkeypatch):
+    monkeypatch.setattr(A, "GEMINI_KEY", None)
+    out, j = run(env)
+    assert all(out[t][1] == A.AI_NO_KEY and j.get(t, "insight") is None for t in TICKERS)
+    assert not any(j.failed(t) or j.failed(t, ("insight",)) for t in TICKERS)
+    # 設定金鑰後一般重跑就會補問
+    monkeypatch.setattr(A, "GEMINI_KEY", "test")
+    out, j = run(env)
+    assert all(out[t][1] == env.gemini.client.text for t in TICKERS)
+
+
+def test_deleted_assets_are_regenerated(env):
+    out, j = run(env)
+    os.remove(os.path.join(A.ASSET_DIR, out["DDD"][0]))
+    m = len(env.processed)
+    out2, j = run(env)
+    assert rebuilt(env, m) == ["DDD"]
+    assert out2 == out and os.path.exists(os.path.join(A.ASSET_DIR, out["DDD"][0]))
+
+
+def test_chart_mode_change_rebuilds_cached_tickers(env):
+    run(env)
+    j = A.RunJournal.load(env.day)
+    for t in TICKERS: j.state["tickers"][t]["images"]["mode"] = "png"  # 前次以 png 模式完成
+    j.flush()
+    m = len(env.processed)
+    out, j = run(env)
+    assert rebuilt(env, m) == TICKERS
+    assert all(j.get(t, "images")["mode"] == "client" and out[t][0].endswith(".json") for t in TICKERS)
+    assert len(glob.glob(os.path.join(A.ASSET_DIR, "*.json"))) == len(TICKERS)
@@ -0,0 +1,67 @@
+# 本地行情庫的增量更新：只補新 K 棒、資料源重新還原權值 (分割 / 除息) 時整段重抓
+import numpy as np
+import pytest
+
+import app_cron as A
+from conftest import FakeDownloader, make_ohlcv
+
+
+@pytest.fixture
+def root(tmp_path):
+    return str(tmp_path / "ohlcv")
+
+
+def stored(ticker, root):
+    return A.load_ohlcv(ticker, root)
+
+
+def test_incremental_refresh_appends_new_bars(root):
+    df = make_ohlcv(300, 1)
+    src = FakeDownloader({"AAA": df.iloc[:290]})
+    assert A.update_ohlcv_store(["AAA"], src, root, today=df.index[289].date()) == {}
+    src.frames["AAA"] = df
+    assert A.update_ohlcv_store(["AAA"], src, root, today=df.index[-1].date()) == {}
+    assert "start" in src.calls[-1][1]  # 只抓缺少的區間
+    np.testing.assert_allclose(stored("AAA", root).to_numpy(), df.to_numpy())
+
+
+def test_last_bar_revised_intraday_is_not_a_rewrite(root):
+    # 盤中抓到的最後一根收盤價之後會變動，不應因此整段重抓
+    df = make_ohlcv(100, 2)
+    partial = df.iloc[:90].copy(); partial.iloc[-1, partial.columns.get_loc("Close")] *= 0.97
+    src = FakeDownloader({"AAA": partial})
+    A.update_ohlcv_store(["AAA"], src, root, today=df.index[89].date())
+    src.frames["AAA"] = df
+    A.update_ohlcv_store(["AAA"], src, root, today=df.index[-1].date())
+    assert [c[1] for c in src.calls[1:]] == [{"start": src.calls[1][1]["start"]}]
+    np.testing.assert_allclose(stored("AAA", root).to_numpy(), df.to_numpy())
+
+
+def test_split_triggers_full_redownload(root):
+    df, other = make_ohlcv(400, 3), make_ohlcv(400, 4)
+    src = FakeDownloader({"SPLT": df.iloc[:390], "KEEP": other.iloc[:390]})
+    A.update_ohlcv_store(["SPLT", "KEEP"], src, root, today=df.index[389].date())
+    # 2:1 分割：資料源回傳整段減半的還原價與新 K 棒
+    adj = df.copy(); adj.loc[:, ["Open", "High", "Low", "Close"]] /= 2
+    src.frames.update(SPLT=adj, KEEP=other)
+    assert A.update_ohlcv_store(["SPLT", "KEEP"], src, root, today=df.index[-1].date()) == {}
+    assert src.calls[-1] == (("SPLT",), {"period": f"{A.HISTORY_YEARS}y"})  # 只有分割的標的整段重抓
+    np.testing.assert_allclose(stored("SPLT", root).to_numpy(), adj.to_numpy())
+    np.testing.assert_allclose(stored("KEEP", root).to_numpy(), other.to_numpy())
+    # 沒有殘留假跳空
+    assert stored("SPLT", root)['Close'].pct_change().abs().max() < 0.2
+
+
+def test_dividend_adjustment_beyond_tolerance_redownloads(root):
+    df = make_ohlcv(200, 5)
+    src = FakeDownloader({"DIV": df.iloc[:195]})
+    A.update_ohlcv_store(["DIV"], src, root, today=df.index[194].date())
+    adj = df.copy(); adj.loc[:df.index[194], ["Open", "High", "Low", "Close"]] *= 0.99  # 1% 除息還原
+    src.frames["DIV"] = adj
+    A.update_ohlcv_store(["DIV"], src, root, today=df.index[-1].date())
+    np.testing.assert_allclose(stored("DIV", root).to_numpy(), adj.to_numpy())
+
+
+def test_failed_download_reports_errors(root):
+    src = FakeDownloader({}, fail={"GONE"})
+    assert A.update_ohlcv_store(["GONE"], src, root, today=make_ohlcv(1, 0).index[-1].date()) == {"GONE": "下載結果無資料"}
@@ -0,0 +1,41 @@
+# 執行剖析：逐階段 / 逐檔彙總牆鐘、CPU 與 RSS 高峰拉高量，例外照常拋出但留下紀錄
+import json
+
+import numpy as np
+import pytest
+
+import app_cron as A
+
+
+def test_stage_and_ticker_summary():
+    p = A.RunProfiler()
+    with p.stage("payload", "AAA"): np.ones((2000, 2000)).sum()
+    with p.stage("payload", "AAA"): pass
+    with p.stage("payload", "BBB"): pass
+    with p.stage("download"): pass
+    p.add("to_image", "AAA", wall=1.5, cpu=0.2, growth=3.0, peak=200.0)
+    prof = p.summary(day="2026-10-16")
+    assert prof["day"] == "2026-10-16"
+    assert prof["stages"]["payload"]["n"] == 3 and prof["stages"]["download"]["n"] == 1
+    aaa = prof["tickers"]["AAA"]
+    assert set(aaa) == {"payload", "to_image"} and "download" not in prof["tickers"]
+    assert aaa["payload"]["wall"] > 0 and aaa["payload"]["cpu"] > 0
+    assert aaa["to_image"] == {"wall": 1.5, "cpu": 0.2, "growth": 3.0}
+    assert prof["stages"]["to_image"]["peak_so_far"] == 200.0
+    if A.resource is not None: assert aaa["payload"]["growth"] is not None and aaa["payload"]["growth"] >= 0
+    json.dumps(prof)
+
+
+def test_errors_are_recorded_and_reraised():
+    p = A.RunProfiler()
+    with pytest.raises(ValueError):
+        with p.stage("gemini"): raise ValueError("boom")
+    assert p.summary()["stages"]["gemini"]["errors"] == 1 and "boom" in p.records[0]["error"]
+
+
+def test_footer_embeds_profile_json():
+    p = A.RunProfiler()
+    with p.stage("write_card", "A</script>"): pass
+    html = A.profile_footer(p.summary())
+    data = html.split('id="run-profile">', 1)[1].rsplit("</script>", 1)[0]
+    assert "</script>" not in data and json.loads(data)["tickers"]["A</script>"]["write_card"]["wall"] >= 0
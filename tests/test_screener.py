@@ -0,0 +1,52 @@
+# Finviz 篩選頁的磁碟快取：TTL 命中、ETag 條件請求、寫入中斷留下的損毀快取
+import os
+import types
+
+import app_cron as A
+
+URL = "https://finviz.test/screener.ashx?v=111"
+
+
+class FakeSession:
+    def __init__(self, text="<html>page</html>", etag='"v1"'):
+        self.text, self.etag, self.calls = text, etag, []
+
+    def get(self, url, headers=None, timeout=None):
+        self.calls.append(dict(headers or {}))
+        if headers and headers.get("If-None-Match") == self.etag:
+            return types.SimpleNamespace(status_code=304, text="", headers={"ETag": self.etag}, raise_for_status=lambda: None)
+        return types.SimpleNamespace(status_code=200, text=self.text, headers={"ETag": self.etag}, raise_for_status=lambda: None)
+
+
+def cache_files(d):
+    return sorted(os.path.join(d, f) for f in os.listdir(d))
+
+
+def test_ttl_hit_and_conditional_refresh(tmp_path):
+    d, s = str(tmp_path), FakeSession()
+    assert A.fetch_screener_page(s, URL, d, ttl=900) == s.text
+    assert A.fetch_screener_page(s, URL, d, ttl=900) == s.text and len(s.calls) == 1
+    # 過期後帶 ETag 重新驗證，304 沿用快取內容
+    assert A.fetch_screener_page(s, URL, d, ttl=0) == s.text
+    assert s.calls[-1] == {"If-None-Match": '"v1"'}
+    assert not [f for f in cache_files(d) if f.endswith(".tmp")]
+
+
+def test_truncated_meta_is_a_cache_miss(tmp_path):
+    d, s = str(tmp_path), FakeSession()
+    A.fetch_screener_page(s, URL, d, ttl=900)
+    meta = next(f for f in cache_files(d) if f.endswith(".json"))
+    with open(meta, "w", encoding="utf-8") as f: f.write('{"url": "https://fin')  # 寫到一半被中斷
+    s.text = "<html>new</html>"
+    assert A.fetch_screener_page(s, URL, d, ttl=900) == "<html>new</html>"
+    assert s.calls[-1] == {}  # 沒有快取可用時不帶條件標頭
+    assert A.fetch_screener_page(s, URL, d, ttl=900) == "<html>new</html>" and len(s.calls) == 2
+
+
+def test_missing_body_with_valid_meta_refetches(tmp_path):
+    d, s = str(tmp_path), FakeSession()
+    A.fetch_screener_page(s, URL, d, ttl=900)
+    os.remove(next(f for f in cache_files(d) if f.endswith(".html")))
+    # meta 仍帶 ETag，但沒有內容可沿用，必須無條件重抓而不是收到 304
+    assert A.fetch_screener_page(s, URL, d, ttl=900) == s.text
+    assert s.calls[-1] == {}